@@ -4,9 +4,12 @@ to different types of events.
 """
 
 import asyncio
+import hashlib
+import json
 import logging
 from textwrap import dedent
 
+from aiohttp import web
 from markdown import markdown
 from parse import parse
 
@@ -16,16 +19,21 @@ from opsdroid.connector.slack import events as slack_events
 from opsdroid.events import (JoinGroup, JoinRoom, Message, NewRoom,
                              OpsdroidStarted, RoomDescription, RoomName,
                              UserInvite)
-from opsdroid.matchers import match_event, match_regex
+from opsdroid.matchers import match_event, match_regex, match_webhook
 from opsdroid.skill import Skill
 
+from .picard.bridge_commands import BridgeCommandChannel
 from .picard.commands import PicardCommands
 from .picard.constraints import (admin_command, constrain_matrix_connector,
                                  constrain_slack_connector, ignore_appservice_users)
 from .picard.matrix import MatrixMixin
 from .picard.matrix_groups import MatrixCommunityMixin
-from .picard.slackbridge import SlackBridgeMixin
-from .picard.util import RoomMemory
+from .picard.metrics import Metrics, timed
+from .picard.ratelimit import RequestScheduler
+from .picard.slack_directory import SlackChannelDirectory, SlackUserDirectory
+from .picard.slackbridge import BridgedRooms, SlackBridgeMixin
+from .picard.util import (AsyncTTLCache, PersistentDict, PersistentSet, RoomMemory,
+                          run_in_pool)
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -35,9 +43,55 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
     def __init__(self, opsdroid, config, *args, **kwargs):
         super().__init__(opsdroid, config, *args, **kwargs)
 
+        self._metrics = Metrics()
+        self._request_scheduler = RequestScheduler(self.config.get("rate_limits"),
+                                                   retries=self.config.get("rate_limit_retries", 3),
+                                                   metrics=self._metrics)
         self._slack_channel_lock = asyncio.Lock()
         self._slack_rename_lock = asyncio.Lock()
+        self._joined_rooms = None
+        self._joined_rooms_lock = asyncio.Lock()
+        self._slack_channels = SlackChannelDirectory(
+            ttl=self.config.get("slack_directory_ttl", 3600))
+        self._slack_channels_lock = asyncio.Lock()
+        self._slack_users = SlackUserDirectory()
+        self._slack_users_lock = asyncio.Lock()
+        self._register_slack_rtm_callbacks()
+        self._slack_user_client = None
+        self._bridge_provisioning_client = None
+        self._bridge_commands = BridgeCommandChannel(
+            self._send_bridge_command,
+            window=self.config.get("bridge_command_window", 5),
+            timeout=self.config.get("bridge_command_timeout", 30),
+            retries=self.config.get("bridge_command_retries", 2))
+        self._slack_user_token_id = None
+        self._slack_bot_token_id = None
+        self._slack_team_id = None
+        self._pending_topics = {}
         self.memory = RoomMemory(self.opsdroid)
+        self._bridged_rooms = BridgedRooms(self.memory)
+        self._known_community_users = PersistentSet(self.memory,
+                                                    "known_community_users",
+                                                    legacy_key="known_community_users")
+        self._community_watcher = None
+        self._alias_cache = AsyncTTLCache(config.get("alias_cache_ttl", 3600),
+                                          negative_ttl=config.get("alias_cache_negative_ttl", 60))
+        self._community_cache = AsyncTTLCache(config.get("community_cache_ttl", 3600))
+        self._welcomed_slack_users = PersistentSet(self.memory,
+                                                   "picard.welcomed_slack_users")
+        self._welcomed_matrix_users = PersistentSet(self.memory,
+                                                    "picard.welcomed_matrix_users")
+        self._archived_rooms = PersistentSet(self.memory, "picard.archived_rooms")
+        self._archive_checked_rooms = PersistentSet(self.memory, "picard.archive_checked_rooms")
+        self._room_members = AsyncTTLCache(config.get("room_members_cache_ttl", 3600))
+        self._autoinvite_users = PersistentSet(self.memory, "picard.autoinvite_users",
+                                               legacy_key="autoinvite_users")
+        self._direct_messages = PersistentDict(self.memory, "picard.direct_messages",
+                                               legacy_key="direct_messages")
+        self._channel_fingerprints = PersistentDict(self.memory, "picard.channel_fingerprints")
+        self._createroom_jobs = PersistentDict(self.memory, "picard.createroom_jobs")
+        self._createroom_queue = None
+        self._createroom_workers = []
 
     @property
     def matrix_connector(self):
@@ -47,6 +101,16 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
     def slack_connector(self):
         return self.opsdroid._connector_names['slack']
 
+    def _install_request_scheduler(self):
+        """
+        Schedule the requests of both connectors, so that everything opsdroid
+        sends for us is scheduled even before picard makes any requests itself.
+        """
+        self._request_scheduler.install_matrix(self.matrix_connector.connection)
+        self._request_scheduler.install_slack(self.slack_connector.slack)
+        self._metrics.install_connector(self.matrix_connector)
+        self._metrics.install_connector(self.slack_connector)
+
     @match_regex('!ping')
     @admin_command
     async def ping(self, message):
@@ -56,18 +120,47 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
     async def memory_command(self, message):
         key = message.regex['key']
         _LOGGER.debug(f"Attempting to get {key} from {message.target} room memory.")
-        with self.memory[message.target]:
-            data = await self.opsdroid.memory.get(key)
+        data = await self.memory.get(key, room=message.target)
         return await message.respond(str(data))
 
+    @match_regex('!stats')
+    @admin_command
+    async def stats_command(self, message):
+        """
+        Show the call counts and latencies picard has recorded.
+        """
+        lines = self._metrics.summary() or ["No requests recorded yet."]
+        queue_depths = self._request_scheduler.queue_depths
+        if queue_depths:
+            lines.append("Queued requests: " + ", ".join(f"{name}: {depth}"
+                                                         for name, depth in queue_depths.items()))
+        lines.append(f"Bridge admin commands: {self._bridge_commands.in_flight} awaiting a reply, "
+                     f"{self._bridge_commands.queue_depth} queued")
+
+        return await message.respond("\n".join(lines))
+
+    @match_webhook('metrics')
+    async def prometheus_metrics(self, request):
+        """
+        Serve the metrics in the Prometheus text format.
+        """
+        return web.Response(text=self._metrics.prometheus(), content_type="text/plain")
 
     @match_regex('!bridgeall')
     @match_event(OpsdroidStarted)
     @admin_command
+    @timed
     async def bridge_all_slack_channels(self, message):
         """
-        Iterate over all slack channels and bridge them one by one.
+        Iterate over all slack channels and bridge them, a few at a time.
         """
+        self._install_request_scheduler()
+        await self._resolve_slack_token_identities()
+
+        if isinstance(message, OpsdroidStarted):
+            await self.resolve_configured_rooms()
+            await self.resume_createroom_jobs()
+
         if (isinstance(message, OpsdroidStarted) and
             not self.config.get("copy_from_slack_startup", True)):
 
@@ -76,40 +169,125 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
 
         await self.opsdroid.send(Message("Running the bridgeall command.", target="main"))
 
-        channels = await self.get_slack_channel_mapping()
-        for slack_channel_id, channel in channels.items():
-            slack_channel_name = channel['name']
-            _LOGGER.info(f"Processing... {slack_channel_name}")
+        concurrency = self.config.get("bridgeall_concurrency", 10)
+        progress_interval = self.config.get("bridgeall_progress_interval", 100)
+        progress = {'done': 0, 'failed': 0, 'listed': 0, 'listing': True}
+        failed_names = []
+
+        async def list_channels():
+            # Start bridging the first page of channels while the rest are listed.
+            channel_ids = set()
+            async for channel in self.iter_slack_channels():
+                self._slack_channels.update(channel)
+                channel_ids.add(channel['id'])
+                progress['listed'] += 1
+                yield channel['id'], channel
+
+            progress['listing'] = False
+            self._slack_channels.mark_loaded(channel_ids)
+
+        async def report_progress(item, error):
+            progress['failed' if error else 'done'] += 1
+            if error:
+                failed_names.append(item[1]['name'])
+            finished = progress['done'] + progress['failed']
+            remaining = progress['listed'] - finished
+            if progress_interval and finished % progress_interval == 0 and remaining:
+                still_listing = " (still listing channels)" if progress['listing'] else ""
+                await self.opsdroid.send(Message(
+                    f"Bridged {progress['done']} channels, {progress['failed']} failed, "
+                    f"{remaining} remaining{still_listing}.",
+                    target="main",
+                    connector=self.matrix_connector))
+
+        summary = "Finished adding all channels"
+        try:
+            await run_in_pool(lambda item: self.bridge_slack_channel(*item),
+                              list_channels(),
+                              concurrency,
+                              on_complete=report_progress)
+        except Exception:
+            _LOGGER.exception("Failed to list the slack channels.")
+            summary = (f"Listing the slack channels failed after {progress['listed']}, "
+                       "finished adding those")
+
+        summary += f", {progress['done']} done, {progress['failed']} failed."
+        if failed_names:
+            summary += f" Failed channels: {', '.join(failed_names)}"
+        await self.opsdroid.send(Message(summary,
+                                         target="main",
+                                         connector=self.matrix_connector))
+
+    # The config options which change how a bridged room is set up.
+    fingerprint_config_keys = ("room_alias_templates", "room_name_template", "room_avatar_url",
+                               "users_as_admin", "users_to_invite", "make_public",
+                               "allow_at_room", "community_id", "related_groups",
+                               "appservice_bot_mxid", "provision_in_one_request")
+
+    def _channel_fingerprint(self, channel):
+        """
+        A hash of everything that goes into bridging and configuring a channel.
+        """
+        config = {key: self.config.get(key) for key in self.fingerprint_config_keys}
+        data = [channel['name'], channel.get('topic', {}).get('value', ''),
+                channel.get('is_archived', False), config]
+        return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+    async def bridge_slack_channel(self, slack_channel_id, channel):
+        """
+        Make sure there is a configured matrix room bridged to this slack channel.
 
-            matrix_room_id = await self.join_or_create_matrix_room(slack_channel_name)
+        Channels which have not changed since they were last bridged are skipped.
+        """
+        fingerprint = self._channel_fingerprint(channel)
+        await self._channel_fingerprints.load()
+        if (self._channel_fingerprints.get(slack_channel_id) == fingerprint and
+                await self._bridged_rooms.matrix_room_id(slack_channel_id)):
+            _LOGGER.debug(f"Skipping {channel['name']}, it has not changed since it was bridged.")
+            return
 
-            # TODO: This iteration doesn't include archived channels.
-            if channel['is_archived'] and matrix_room_id:
-                # await self.archive_matrix_room(matrix_room_id)
-                continue
+        await self._bridge_slack_channel(slack_channel_id, channel)
 
-            if not matrix_room_id:
-                matrix_room_id = await self.create_new_matrix_room()
+        await self._channel_fingerprints.set(slack_channel_id, fingerprint)
 
-            await self.configure_new_matrix_room_pre_bridge(matrix_room_id,
-                                                            self.config.get("make_public", False))
+    async def _bridge_slack_channel(self, slack_channel_id, channel):
+        slack_channel_name = channel['name']
+        _LOGGER.info(f"Processing... {slack_channel_name}")
 
-            # Link the two rooms
-            await self.link_room(matrix_room_id, slack_channel_id)
+        if self.config.get("provision_in_one_request", False):
+            matrix_room_id = await self.matrix_room_id_from_aliases(slack_channel_name)
+            if matrix_room_id is None:
+                await self.create_bridged_matrix_room(slack_channel_name,
+                                                      channel['topic']['value'],
+                                                      slack_channel_id)
+                return
 
-            # Setup the matrix room
-            await self.configure_new_matrix_room_post_bridge(matrix_room_id,
-                                                             slack_channel_name,
-                                                             channel['topic']['value'],
-                                                             _bridgeall=False)
+        matrix_room_id = await self.join_or_create_matrix_room(slack_channel_name)
 
-        await self.opsdroid.send(Message("Finished adding all channels.",
-                                         target="main",
-                                         connector=self.matrix_connector))
+        # TODO: This iteration doesn't include archived channels.
+        if channel['is_archived'] and matrix_room_id:
+            # await self.archive_matrix_room(matrix_room_id)
+            return
+
+        if not matrix_room_id:
+            matrix_room_id = await self.create_new_matrix_room()
+
+        await self.configure_new_matrix_room_pre_bridge(matrix_room_id,
+                                                        self.config.get("make_public", False))
+
+        # Link the two rooms
+        await self.link_room(matrix_room_id, slack_channel_id)
+
+        # Setup the matrix room
+        await self.configure_new_matrix_room_post_bridge(matrix_room_id,
+                                                         slack_channel_name,
+                                                         channel['topic']['value'],
+                                                         _bridgeall=False)
 
     @match_event(slack_events.ChannelArchived)
     async def on_archive_slack_channel(self, archive):
         _LOGGER.info(f"Got slack archive event for {archive.target}")
+        self._slack_channels.discard(archive.target)
         matrix_room_id = await self.matrix_room_id_from_slack_channel_id(archive.target)
         if not matrix_room_id:
             _LOGGER.debug(f"Could not get matrix room id for slack channel {archive.target} to archive it.")
@@ -121,6 +299,7 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
 
     @match_event(slack_events.ChannelUnarchived)
     async def on_unarchive_slack_channel(self, unarchive):
+        self._slack_channels.discard(unarchive.target)
         matrix_room_id = await self.matrix_room_id_from_slack_channel_id(unarchive.target)
         if matrix_room_id:
             _LOGGER.debug(f"Found exisiting matrix room for slack channel {unarchive.target} unarchiving it.")
@@ -135,6 +314,7 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
 
     @match_event(NewRoom)
     @constrain_slack_connector
+    @timed
     async def on_new_slack_channel(self, channel):
         """
         React to a new slack channel event.
@@ -144,6 +324,10 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
             _LOGGER.info("Ignoring channel create event from slack, creation locked.")
             return
 
+        # Look the new channel up on its own the first time it is needed,
+        # rather than relisting every channel.
+        self._slack_channels.discard(channel.target)
+
         is_public = self.config.get("make_public", False)
         matrix_room_id = await self.join_or_create_matrix_room(channel.name)
 
@@ -163,30 +347,67 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
 
         await self.announce_new_room(canonical_alias, channel.user, topic)
 
+    async def _latest_topic_change(self, topic):
+        """
+        Wait to see if the topic of the room changes again.
+
+        Returns `True` if this is still the latest change of the room's topic
+        once ``topic_debounce_seconds`` have passed without another one, so
+        only the final value of a burst of edits is bridged.
+        """
+        delay = self.config.get("topic_debounce_seconds", 2)
+        if not delay:
+            return True
+
+        key = (topic.connector.name, topic.target)
+        self._pending_topics[key] = topic
+        await asyncio.sleep(delay)
+        if self._pending_topics.get(key) is not topic:
+            _LOGGER.debug(f"Skipping topic change in {topic.target}, it has changed again.")
+            return False
+
+        del self._pending_topics[key]
+        return True
+
     @match_event(RoomDescription)
     async def on_topic_change(self, topic):
         """Handle a topic change."""
         _LOGGER.debug(f"Got RoomDescription object from {topic.connector.name}")
         if topic.connector is self.matrix_connector:
-            with self.memory[topic.target]:
-                room_options = await self.opsdroid.memory.get("picard.options") or {}
+            # Ignore the echo of topics picard set itself.
+            if (topic.raw_event or {}).get('sender') == self.matrix_connector.mxid:
+                return
+
+            if not await self._latest_topic_change(topic):
+                return
+
+            room_options = await self.memory.get("picard.options", room=topic.target) or {}
 
             if not room_options.get("skip_room_description"):
-                _LOGGER.debug(f"Setting slack room description to: {topic.description}")
                 slack_channel_id = await self.slack_channel_id_from_matrix_room_id(topic.target)
+                channel = self._slack_channels.get(slack_channel_id)
+                if channel and channel.get('topic', {}).get('value') == topic.description:
+                    _LOGGER.debug(f"Slack channel {slack_channel_id} already has this topic.")
+                    return
+
+                _LOGGER.debug(f"Setting slack room description to: {topic.description}")
                 await self.set_slack_channel_description(slack_channel_id, topic.description)
             else:
                 _LOGGER.debug("Matrix Connector: Not setting topic because of room options.")
 
         elif topic.connector is self.slack_connector:
-            user_id = await self._id_for_slack_user_token()
-            if topic.raw_event['user'] == user_id:
+            self._slack_channels.set_topic(topic.target, topic.description)
+
+            picard_ids = {await self._id_for_slack_user_token(),
+                          await self._id_for_slack_bot_token()}
+            if topic.raw_event['user'] in picard_ids:
+                return
+
+            if not await self._latest_topic_change(topic):
                 return
 
-            slack_channel_name = await self.get_slack_channel_name(topic.target)
-            matrix_room_id = await self.matrix_room_id_from_slack_channel_name(slack_channel_name)
-            with self.memory[matrix_room_id]:
-                room_options = await self.opsdroid.memory.get("picard.options") or {}
+            matrix_room_id = await self.matrix_room_id_from_slack_channel_id(topic.target)
+            room_options = await self.memory.get("picard.options", room=matrix_room_id) or {}
 
             if not room_options.get("skip_room_description"):
                 _LOGGER.debug(f"Setting matrix room description to: {topic.description}")
@@ -199,6 +420,15 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
                 _LOGGER.debug(f"{room_options}")
                 _LOGGER.debug("Slack Connector: Not setting topic because of room options.")
 
+    @match_event(RoomName)
+    @constrain_slack_connector
+    async def on_slack_channel_rename(self, room_name):
+        """
+        Keep the slack channel directory up to date when a channel is renamed.
+        """
+        # on_name_change is disabled, so this only updates picard's view of slack.
+        self._slack_channels.rename(room_name.target, room_name.name)
+
     # This is misbehaving, disabling for pyastro20
     # @match_event(RoomName)
     async def on_name_change(self, room_name):
@@ -224,8 +454,7 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
             if old_name == name:
                 return
 
-        with self.memory[matrix_room_id]:
-            room_options = await self.opsdroid.memory.get("picard.options") or {}
+        room_options = await self.memory.get("picard.options", room=matrix_room_id) or {}
         if room_options.get("skip_room_name"):
             return
 
@@ -252,13 +481,14 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
         Join all rooms on invite.
         """
         await invite.respond(JoinRoom())
+        self._set_joined_matrix_room(invite.target)
 
         if await self.is_one_to_one_chat(invite.target):
-            dms = await self.opsdroid.memory.get("direct_messages") or {}
-            dms.update({invite.raw_event['sender']: invite.target})
-            await self.opsdroid.memory.put("direct_messages", dms)
+            await self._direct_messages.set(invite.raw_event['sender'], invite.target)
 
-            return await self.send_matrix_welcome_message(invite.target)
+            await self.send_matrix_welcome_message(invite.target)
+            if self.config.get('welcome', {}).get('matrix'):
+                await self._welcomed_matrix_users.add(invite.raw_event['sender'])
 
     @match_event(JoinGroup)
     @constrain_matrix_connector
@@ -266,16 +496,18 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
         """
         React to a new user joining the community on matrix.
         """
-        dms = await self.opsdroid.memory.get("direct_messages") or {}
+        dms = self._direct_messages
+        await dms.load()
 
         if join.user_id not in dms:
             matrix_room_id = await self.create_new_matrix_direct_message(join.user_id)
-            dms.update({join.user_id: matrix_room_id})
-            await self.opsdroid.memory.put("direct_messages", dms)
+            await dms.set(join.user_id, matrix_room_id)
         else:
             matrix_room_id = dms[join.user_id]
 
         await self.send_matrix_welcome_message(matrix_room_id)
+        if self.config.get('welcome', {}).get('matrix'):
+            await self._welcomed_matrix_users.add(join.user_id)
 
     async def send_matrix_welcome_message(self, matrix_room_id):
         """
@@ -294,19 +526,37 @@ class Picard(Skill, PicardCommands, MatrixMixin, SlackBridgeMixin, MatrixCommuni
         """
         React to a new user joining the team on slack.
         """
-        return await self.send_slack_welcome_message(join.user_id)
+        user = (join.raw_event or {}).get('user')
+        if isinstance(user, dict):
+            self.update_slack_user(user)
+
+        await self.send_slack_welcome_message(join.user_id)
+        if self.config.get('welcome', {}).get('slack'):
+            await self._welcomed_slack_users.add(join.user_id)
 
     async def send_slack_welcome_message(self, slack_user_id):
         """
         Send the welcome message to a slack 1-1.
         """
         welcome_message = self.config.get('welcome', {}).get('slack')
-        slack_room_id = await self.get_slack_direct_message_channel(slack_user_id)
         if welcome_message:
+            slack_room_id = await self.get_slack_direct_message_channel(slack_user_id)
             return await self.opsdroid.send(Message(dedent(welcome_message),
                                                     target=slack_room_id,
                                                     connector=self.slack_connector))
 
+    async def resolve_configured_rooms(self):
+        """
+        Look up the rooms named in the config, so they are cached before they are needed.
+        """
+        room_name = self.config.get("announcement_room_name")
+        if not room_name:
+            return
+        try:
+            await self.matrix_room_id_from_slack_channel_name(room_name)
+        except Exception:
+            _LOGGER.exception(f"Failed to look up the announcement room {room_name}.")
+
     async def announce_new_room(self, matrix_room_alias, username, topic):
         """
         Send a message to the configured room announcement room.
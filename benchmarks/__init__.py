@@ -0,0 +1,3 @@
+"""
+An offline benchmark suite for picard, see ``python -m benchmarks.run --help``.
+"""
@@ -0,0 +1,356 @@
+"""
+A stand-in for the parts of the matrix client-server and groups APIs picard uses.
+"""
+import asyncio
+import itertools
+import json
+import re
+from urllib.parse import unquote
+
+from aiohttp import web
+
+from .fake_service import FakeService
+
+__all__ = ['FakeMatrixServer']
+
+
+class FakeMatrixServer(FakeService):
+    """
+    An in-memory homeserver called ``server_name``.
+
+    The rooms given in ``aliases`` (a list of alias localparts) exist when it
+    starts. If ``community_id`` is given, the community exists with
+    ``community_users`` users and ``community_rooms`` rooms in it.
+
+    If ``bridge_bot`` and ``bridge_room`` (an alias localpart) are given, that
+    user answers every message sent to that room with notices, the way the
+    slack appservice answers admin commands. The notices are the only events
+    ``/sync`` returns, one per response like the opsdroid connector reads them.
+    """
+    uncounted_operations = ("GET sync",)
+
+    def __init__(self, server_name="bench.local", aliases=(), community_id=None,
+                 community_users=0, community_rooms=0, bridge_bot=None, bridge_room=None,
+                 **kwargs):
+        super().__init__(**kwargs)
+        self.server_name = server_name
+        self.rooms = {}
+        self.aliases = {}
+        self.groups = {}
+        self._ids = itertools.count()
+        self._timeline = []
+        self._timeline_changed = asyncio.Condition()
+        self._stopping = False
+
+        for localpart in aliases:
+            self.aliases[f"#{localpart}:{server_name}"] = self._new_room()
+
+        self.bridge_bot = bridge_bot
+        self.bridge_room_id = None
+        if bridge_bot and bridge_room:
+            self.bridge_room_id = self.aliases[f"#{bridge_room}:{server_name}"]
+            self._set_membership(self.bridge_room_id, bridge_bot, "join")
+
+        if community_id:
+            self.groups[community_id] = {
+                'users': {f"@user{i}:{server_name}" for i in range(community_users)},
+                'rooms': {self._new_room() for _ in range(community_rooms)},
+            }
+
+        self.routes = [
+            ("POST", r"login", self.login),
+            ("GET", r"sync", self.sync),
+            ("POST", r"user/(?P<user_id>[^/]+)/filter", self.create_filter),
+            ("GET", r"profile/(?P<user_id>[^/]+)/displayname", self.get_displayname),
+            ("PUT", r"profile/(?P<user_id>[^/]+)/displayname", self.ok),
+            ("GET", r"joined_rooms", self.joined_rooms),
+            ("POST", r"createRoom", self.create_room),
+            ("GET", r"directory/room/(?P<alias>[^/]+)", self.get_alias),
+            ("PUT", r"directory/room/(?P<alias>[^/]+)", self.put_alias),
+            ("DELETE", r"directory/room/(?P<alias>[^/]+)", self.delete_alias),
+            ("POST", r"join/(?P<room>[^/]+)", self.join),
+            ("POST", r"rooms/(?P<room>[^/]+)/join", self.join),
+            ("POST", r"rooms/(?P<room>[^/]+)/leave", self.leave),
+            ("POST", r"rooms/(?P<room>[^/]+)/invite", self.invite),
+            ("GET", r"rooms/(?P<room>[^/]+)/state", self.get_state),
+            ("GET", r"rooms/(?P<room>[^/]+)/state/(?P<type>[^/]+)(/(?P<key>[^/]*))?",
+             self.get_state_event),
+            ("PUT", r"rooms/(?P<room>[^/]+)/state/(?P<type>[^/]+)(/(?P<key>[^/]*))?",
+             self.put_state_event),
+            ("PUT", r"rooms/(?P<room>[^/]+)/send/(?P<type>[^/]+)/(?P<txn>[^/]+)", self.send),
+            ("GET", r"rooms/(?P<room>[^/]+)/joined_members", self.joined_members),
+            ("POST", r"create_group", self.create_group),
+            ("GET", r"groups/(?P<group>[^/]+)/profile", self.group_profile),
+            ("GET", r"groups/(?P<group>[^/]+)/users", self.group_users),
+            ("GET", r"groups/(?P<group>[^/]+)/rooms", self.group_rooms),
+            ("PUT", r"groups/(?P<group>[^/]+)/admin/rooms/(?P<room>[^/]+)", self.group_add_room),
+            ("PUT", r"groups/(?P<group>[^/]+)/admin/users/invite/(?P<user_id>[^/]+)",
+             self.group_invite),
+            ("PUT", r"groups/(?P<group>[^/]+)/settings/m.join_policy", self.ok),
+        ]
+        self.routes = [(method, re.compile(pattern + "$"), handler)
+                       for method, pattern, handler in self.routes]
+
+    async def stop(self):
+        # Answer the syncs still waiting for an event, so they don't outlive the server.
+        async with self._timeline_changed:
+            self._stopping = True
+            self._timeline_changed.notify_all()
+        await super().stop()
+
+    def _new_room(self, creator=None):
+        room_id = f"!room{next(self._ids)}:{self.server_name}"
+        self.rooms[room_id] = {'state': {}, 'members': {}}
+        if creator:
+            self._set_membership(room_id, creator, "join")
+        return room_id
+
+    def _set_membership(self, room_id, user_id, membership):
+        self.rooms[room_id]['members'][user_id] = membership
+        self.rooms[room_id]['state'][("m.room.member", user_id)] = {'membership': membership}
+
+    @staticmethod
+    def _error(status, errcode, error=""):
+        return web.json_response({'errcode': errcode, 'error': error}, status=status)
+
+    def _tail(self, request):
+        """
+        The path after the API prefix, with each segment unquoted.
+        """
+        segments = request.raw_path.split('?', 1)[0].split('/')
+        # /_matrix/client/r0/...
+        return '/'.join(unquote(segment) for segment in segments[4:])
+
+    def _resolve(self, request, room):
+        return self.aliases.get(room, room)
+
+    def operation(self, request):
+        tail = self._tail(request)
+        for method, pattern, handler in self.routes:
+            if method == request.method and pattern.match(tail):
+                return f"{method} {handler.__name__}"
+        return f"{request.method} unknown"
+
+    def rate_limited_response(self, retry_after):
+        return web.json_response({'errcode': "M_LIMIT_EXCEEDED",
+                                  'error': "Too many requests",
+                                  'retry_after_ms': int(retry_after * 1000) + 1},
+                                 status=429)
+
+    async def handle(self, request):
+        tail = self._tail(request)
+        for method, pattern, handler in self.routes:
+            match = pattern.match(tail)
+            if method == request.method and match:
+                body = {}
+                if request.can_read_body:
+                    text = await request.text()
+                    body = json.loads(text) if text else {}
+                return await handler(request, body, **match.groupdict())
+
+        return self._error(404, "M_UNRECOGNIZED", f"Unrecognized request {tail}")
+
+    def _user(self, request):
+        return request.headers.get('Authorization', '').replace("Bearer ", "") or None
+
+    # Client-server API
+
+    async def ok(self, request, body, **kwargs):
+        return web.json_response({})
+
+    async def login(self, request, body):
+        user = body.get('user') or body.get('identifier', {}).get('user')
+        if not user.startswith('@'):
+            user = f"@{user}:{self.server_name}"
+        # The access token is the user id, so requests know who made them.
+        return web.json_response({'access_token': user, 'user_id': user,
+                                  'device_id': body.get('device_id', "BENCH")})
+
+    async def _add_to_timeline(self, room_id, event):
+        event = dict(event, room_id=room_id, event_id=f"${next(self._ids)}",
+                     origin_server_ts=0)
+        async with self._timeline_changed:
+            self._timeline.append(event)
+            self._timeline_changed.notify_all()
+
+    async def _bridge_reply(self, command):
+        """
+        Answer an admin command with the notices the slack appservice sends.
+        """
+        verb, _, args = command.partition(' ')
+        if verb == "link":
+            replies = ["Room is now ready",
+                       "Remember to invite the slack bot to the slack channel."]
+        elif verb == "unlink":
+            replies = ["Unlinked"]
+        elif verb == "leave":
+            replies = [f"Draining 0 ghosts from {args}", "Drained"]
+        else:
+            replies = [f"Unrecognised command: {verb}"]
+
+        for reply in replies:
+            await self._add_to_timeline(self.bridge_room_id, {
+                'type': "m.room.message",
+                'sender': self.bridge_bot,
+                'content': {'msgtype': "m.notice", 'body': reply}})
+
+    async def sync(self, request, body):
+        if 'since' not in request.query:
+            # The initial sync only needs to say where the timeline is up to.
+            return web.json_response({'next_batch': str(len(self._timeline)),
+                                      'rooms': {'join': {}, 'invite': {}}})
+
+        position = int(request.query['since'])
+        timeout = int(request.query.get('timeout', 0)) / 1000
+        async with self._timeline_changed:
+            try:
+                await asyncio.wait_for(self._timeline_changed.wait_for(
+                    lambda: self._stopping or position < len(self._timeline)), min(timeout, 1))
+            except asyncio.TimeoutError:
+                pass
+
+        if position >= len(self._timeline):
+            return web.json_response({'next_batch': str(position),
+                                      'rooms': {'join': {}, 'invite': {}}})
+
+        event = self._timeline[position]
+        return web.json_response({
+            'next_batch': str(position + 1),
+            'rooms': {'join': {event['room_id']: {'timeline': {'events': [event]}}},
+                      'invite': {}}})
+
+    async def get_displayname(self, request, body, user_id):
+        return web.json_response({'displayname': user_id[1:].split(':', 1)[0]})
+
+    async def create_filter(self, request, body, user_id):
+        return web.json_response({'filter_id': "1"})
+
+    async def joined_rooms(self, request, body):
+        user = self._user(request)
+        rooms = [room_id for room_id, room in self.rooms.items()
+                 if room['members'].get(user) == "join"]
+        return web.json_response({'joined_rooms': rooms})
+
+    async def create_room(self, request, body):
+        user = self._user(request)
+        room_id = self._new_room(creator=user)
+        state = self.rooms[room_id]['state']
+
+        power_levels = {'users': {user: 100}}
+        power_levels.update(body.get('power_level_content_override', {}))
+        state[("m.room.power_levels", "")] = power_levels
+        for event in body.get('initial_state', []):
+            state[(event['type'], event.get('state_key', ""))] = event['content']
+        if 'name' in body:
+            state[("m.room.name", "")] = {'name': body['name']}
+        if 'topic' in body:
+            state[("m.room.topic", "")] = {'topic': body['topic']}
+        for invitee in body.get('invite', []):
+            self._set_membership(room_id, invitee, "invite")
+
+        if 'room_alias_name' in body:
+            alias = f"#{body['room_alias_name']}:{self.server_name}"
+            if alias in self.aliases:
+                del self.rooms[room_id]
+                return self._error(400, "M_ROOM_IN_USE", "Room alias already taken")
+            self.aliases[alias] = room_id
+            state[("m.room.canonical_alias", "")] = {'alias': alias}
+
+        return web.json_response({'room_id': room_id})
+
+    async def get_alias(self, request, body, alias):
+        if alias not in self.aliases:
+            return self._error(404, "M_NOT_FOUND", f"Room alias {alias} not found")
+        return web.json_response({'room_id': self.aliases[alias], 'servers': [self.server_name]})
+
+    async def put_alias(self, request, body, alias):
+        if alias in self.aliases:
+            return self._error(409, "M_UNKNOWN", f"Room alias {alias} already exists")
+        self.aliases[alias] = body['room_id']
+        return web.json_response({})
+
+    async def delete_alias(self, request, body, alias):
+        if self.aliases.pop(alias, None) is None:
+            return self._error(404, "M_NOT_FOUND", f"Room alias {alias} not found")
+        return web.json_response({})
+
+    async def join(self, request, body, room):
+        room_id = self._resolve(request, room)
+        if room_id not in self.rooms:
+            return self._error(404, "M_NOT_FOUND", "No known servers")
+        self._set_membership(room_id, self._user(request), "join")
+        return web.json_response({'room_id': room_id})
+
+    async def leave(self, request, body, room):
+        self._set_membership(room, self._user(request), "leave")
+        return web.json_response({})
+
+    async def invite(self, request, body, room):
+        if room not in self.rooms:
+            return self._error(404, "M_NOT_FOUND", "Unknown room")
+        if self.rooms[room]['members'].get(body['user_id']) == "join":
+            return self._error(403, "M_FORBIDDEN", f"{body['user_id']} is already in the room.")
+        self._set_membership(room, body['user_id'], "invite")
+        return web.json_response({})
+
+    async def get_state(self, request, body, room):
+        if room not in self.rooms:
+            return self._error(404, "M_NOT_FOUND", "Unknown room")
+        events = [{'type': event_type, 'state_key': state_key, 'content': content,
+                   'room_id': room}
+                  for (event_type, state_key), content in self.rooms[room]['state'].items()]
+        return web.json_response(events)
+
+    async def get_state_event(self, request, body, room, type, key=None):
+        content = self.rooms.get(room, {}).get('state', {}).get((type, key or ""))
+        if content is None:
+            return self._error(404, "M_NOT_FOUND", "Event not found.")
+        return web.json_response(content)
+
+    async def put_state_event(self, request, body, room, type, key=None):
+        if room not in self.rooms:
+            return self._error(404, "M_NOT_FOUND", "Unknown room")
+        self.rooms[room]['state'][(type, key or "")] = body
+        return web.json_response({'event_id': f"${next(self._ids)}"})
+
+    async def send(self, request, body, room, type, txn):
+        if room not in self.rooms:
+            return self._error(404, "M_NOT_FOUND", "Unknown room")
+        if (room == self.bridge_room_id and type == "m.room.message"
+                and self._user(request) != self.bridge_bot):
+            await self._bridge_reply(body.get('body', ""))
+        return web.json_response({'event_id': f"${next(self._ids)}"})
+
+    async def joined_members(self, request, body, room):
+        memberships = self.rooms.get(room, {}).get('members', {})
+        members = {user: {} for user, membership in memberships.items() if membership == "join"}
+        return web.json_response({'joined': members})
+
+    # Groups API
+
+    async def create_group(self, request, body):
+        group_id = f"+{body['localpart']}:{self.server_name}"
+        self.groups.setdefault(group_id, {'users': {self._user(request)}, 'rooms': set()})
+        return web.json_response({'group_id': group_id})
+
+    async def group_profile(self, request, body, group):
+        if group not in self.groups:
+            return self._error(404, "M_UNKNOWN", "Group does not exist")
+        return web.json_response({'name': group})
+
+    async def group_users(self, request, body, group):
+        users = self.groups.get(group, {}).get('users', ())
+        return web.json_response({'chunk': [{'user_id': user} for user in users],
+                                  'total_user_count_estimate': len(users)})
+
+    async def group_rooms(self, request, body, group):
+        rooms = self.groups.get(group, {}).get('rooms', ())
+        return web.json_response({'chunk': [{'room_id': room} for room in rooms],
+                                  'total_room_count_estimate': len(rooms)})
+
+    async def group_add_room(self, request, body, group, room):
+        self.groups[group]['rooms'].add(room)
+        return web.json_response({})
+
+    async def group_invite(self, request, body, group, user_id):
+        return web.json_response({'state': "invite"})
@@ -0,0 +1,103 @@
+"""
+The parts shared by the fake matrix homeserver and the fake slack API.
+"""
+import asyncio
+import logging
+import time
+from collections import Counter
+
+from aiohttp import web
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class FakeService:
+    """
+    An aiohttp server which counts the requests made to it, delays every
+    response by ``latency`` seconds and, if ``rate_limit`` is given, rate
+    limits clients to that many requests per second in bursts of ``burst``.
+
+    Operations in ``uncounted_operations`` are not counted, delayed or rate
+    limited; they are for the benchmark's plumbing rather than picard's work.
+    """
+    uncounted_operations = ()
+
+    def __init__(self, latency=0, rate_limit=None, burst=10):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.burst = burst
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._runner = None
+        self.url = None
+
+    def _take_token(self):
+        """
+        Returns `None` if the request is allowed, otherwise the number of
+        seconds the client should wait.
+        """
+        if self.rate_limit is None:
+            return None
+
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate_limit)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return None
+        return (1 - self._tokens) / self.rate_limit
+
+    def rate_limited_response(self, retry_after):
+        raise NotImplementedError
+
+    async def handle(self, request):
+        raise NotImplementedError
+
+    def operation(self, request):
+        """
+        The name calls to this request are counted under.
+        """
+        raise NotImplementedError
+
+    async def _handle(self, request):
+        operation = self.operation(request)
+        if operation in self.uncounted_operations:
+            return await self.handle(request)
+        self.calls[operation] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        retry_after = self._take_token()
+        if retry_after is not None:
+            self.rate_limited[operation] += 1
+            return self.rate_limited_response(retry_after)
+
+        return await self.handle(request)
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application(client_max_size=16 * 1024 ** 2)
+        app.router.add_route("*", "/{tail:.*}", self._handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        _LOGGER.info(f"{type(self).__name__} listening on {self.url}")
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def reset_counts(self):
+        self.calls.clear()
+        self.rate_limited.clear()
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
@@ -0,0 +1,172 @@
+"""
+A stand-in for the parts of the slack Web API picard uses.
+"""
+import itertools
+
+from aiohttp import web
+
+from .fake_service import FakeService
+
+__all__ = ['FakeSlackAPI']
+
+
+class FakeSlackAPI(FakeService):
+    """
+    An in-memory slack workspace with ``channels`` public channels and ``users`` users.
+
+    List methods are paginated with cursors like the real API.
+    """
+    def __init__(self, channels=0, users=0, **kwargs):
+        super().__init__(**kwargs)
+        self._ids = itertools.count()
+        self.bot_user_id = "UBOT"
+        self.admin_user_id = "UADMIN"
+
+        self.users = {}
+        self._add_user(self.bot_user_id, "picard", is_bot=True)
+        self._add_user(self.admin_user_id, "admin")
+        for i in range(users):
+            self._add_user(f"U{i:08d}", f"user{i}")
+
+        self.channels = {}
+        for i in range(channels):
+            self._add_channel(f"channel-{i}", topic=f"The topic of channel {i}")
+
+        self.methods = {
+            'auth.test': self.auth_test,
+            'users.list': self.users_list,
+            'users.info': self.users_info,
+            'channels.list': self.channels_list,
+            'channels.info': self.channels_info,
+            'channels.create': self.channels_create,
+            'channels.setTopic': self.channels_set_topic,
+            'channels.rename': self.channels_rename,
+            'channels.invite': self.channels_invite,
+            'channels.join': self.channels_join,
+            'im.open': self.im_open,
+            'chat.postMessage': self.chat_post_message,
+        }
+
+    def _add_user(self, user_id, name, is_bot=False):
+        self.users[user_id] = {'id': user_id, 'name': name, 'is_bot': is_bot, 'deleted': False,
+                               'profile': {'display_name': name, 'real_name': name,
+                                           'bot_id': f"B{user_id}" if is_bot else None}}
+
+    def _add_channel(self, name, topic="", creator=None):
+        channel_id = f"C{next(self._ids):08d}"
+        self.channels[channel_id] = {'id': channel_id, 'name': name, 'is_channel': True,
+                                     'is_archived': False, 'created': 0,
+                                     'members': [creator] if creator else [],
+                                     'topic': {'value': topic, 'creator': "", 'last_set': 0},
+                                     'purpose': {'value': "", 'creator': "", 'last_set': 0}}
+        return self.channels[channel_id]
+
+    def _user(self, request):
+        token = request.headers.get('Authorization', '').replace("Bearer ", "")
+        return self.bot_user_id if token.startswith("xoxb") else self.admin_user_id
+
+    @staticmethod
+    def _ok(**data):
+        return web.json_response(dict(ok=True, **data))
+
+    @staticmethod
+    def _error(error):
+        return web.json_response({'ok': False, 'error': error})
+
+    @staticmethod
+    def _page(items, args, key):
+        limit = int(args.get('limit') or 0) or len(items) or 1
+        start = int(args.get('cursor') or 0)
+        page = items[start:start + limit]
+        next_cursor = str(start + limit) if start + limit < len(items) else ""
+        return {key: page, 'response_metadata': {'next_cursor': next_cursor}}
+
+    def operation(self, request):
+        return request.path.rsplit('/', 1)[-1]
+
+    def rate_limited_response(self, retry_after):
+        return web.json_response({'ok': False, 'error': "ratelimited"}, status=429,
+                                 headers={'Retry-After': str(int(retry_after) + 1)})
+
+    async def handle(self, request):
+        args = dict(request.query)
+        if request.can_read_body:
+            if request.content_type == "application/json":
+                args.update(await request.json())
+            else:
+                args.update(await request.post())
+
+        method = self.methods.get(self.operation(request))
+        if method is None:
+            # Anything picard doesn't rely on the result of just succeeds.
+            return self._ok()
+        return await method(request, args)
+
+    async def auth_test(self, request, args):
+        user = self._user(request)
+        return self._ok(user_id=user, user=self.users[user]['name'], team="Bench", team_id="TBENCH")
+
+    async def users_list(self, request, args):
+        return self._ok(**self._page(list(self.users.values()), args, 'members'))
+
+    async def users_info(self, request, args):
+        user = self.users.get(args.get('user'))
+        if user is None:
+            return self._error("user_not_found")
+        return self._ok(user=user)
+
+    async def channels_list(self, request, args):
+        channels = list(self.channels.values())
+        if str(args.get('exclude_archived', '')).lower() in ("1", "true"):
+            channels = [c for c in channels if not c['is_archived']]
+        return self._ok(**self._page(channels, args, 'channels'))
+
+    async def channels_info(self, request, args):
+        channel = self.channels.get(args.get('channel'))
+        if channel is None:
+            return self._error("channel_not_found")
+        return self._ok(channel=channel)
+
+    async def channels_create(self, request, args):
+        if any(c['name'] == args['name'] for c in self.channels.values()):
+            return self._error("name_taken")
+        return self._ok(channel=self._add_channel(args['name'], creator=self._user(request)))
+
+    async def channels_set_topic(self, request, args):
+        channel = self.channels.get(args.get('channel'))
+        if channel is None:
+            return self._error("channel_not_found")
+        channel['topic']['value'] = args['topic']
+        return self._ok(topic=args['topic'])
+
+    async def channels_rename(self, request, args):
+        channel = self.channels.get(args.get('channel'))
+        if channel is None:
+            return self._error("channel_not_found")
+        channel['name'] = args['name']
+        return self._ok(channel=channel)
+
+    async def channels_invite(self, request, args):
+        channel = self.channels.get(args.get('channel'))
+        if channel is None:
+            return self._error("channel_not_found")
+        if args['user'] in channel['members']:
+            return self._error("already_in_channel")
+        channel['members'].append(args['user'])
+        return self._ok(channel=channel)
+
+    async def channels_join(self, request, args):
+        channel = next((c for c in self.channels.values() if c['name'] == args.get('name')), None)
+        if channel is None:
+            return self._error("channel_not_found")
+        user = self._user(request)
+        if user not in channel['members']:
+            channel['members'].append(user)
+        return self._ok(channel=channel)
+
+    async def im_open(self, request, args):
+        return self._ok(channel={'id': f"D{args['user']}"})
+
+    async def chat_post_message(self, request, args):
+        return self._ok(channel=args.get('channel'), ts=f"{next(self._ids)}.000",
+                        message={'text': args.get('text', "")})
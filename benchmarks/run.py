@@ -0,0 +1,304 @@
+"""
+Benchmark picard's main operations against fake matrix and slack servers.
+
+Run from the root of the repository with opsdroid installed::
+
+    python -m benchmarks.run --sizes 100 1000 10000 --latency 0.005
+
+For every workspace size a new fake homeserver and slack workspace with that
+many channels, users and community rooms is started, and each operation is
+run against it in turn, reporting the wall time and the number of API calls
+it made.
+"""
+import argparse
+import asyncio
+import gettext
+import importlib.util
+import logging
+import re
+import sys
+import time
+from pathlib import Path
+
+from opsdroid.connector.matrix import ConnectorMatrix
+from opsdroid.connector.slack import ConnectorSlack
+from opsdroid.core import OpsDroid
+from opsdroid.database import Database
+from opsdroid.events import Message
+
+from .fake_matrix import FakeMatrixServer
+from .fake_slack import FakeSlackAPI
+
+_LOGGER = logging.getLogger(__name__)
+
+ROOT = Path(__file__).resolve().parent.parent
+SERVER_NAME = "bench.local"
+COMMUNITY_ID = f"+bench:{SERVER_NAME}"
+ADMIN = f"@admin:{SERVER_NAME}"
+
+BENCHMARKS = ("bridgeall", "createroom", "welcomeall", "inviteall", "watch_new_users")
+
+
+class MemoryDatabase(Database):
+    """
+    An in-memory database which, like database-matrix, keeps memory per room.
+    """
+    def __init__(self, config=None, opsdroid=None):
+        super().__init__(config or {}, opsdroid=opsdroid)
+        self.name = "benchmark"
+        self.room = "main"
+        self._data = {}
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def put(self, key, data):
+        self._data[(self.room, key)] = data
+
+    async def get(self, key):
+        return self._data.get((self.room, key))
+
+    async def delete(self, key):
+        self._data.pop((self.room, key), None)
+
+
+def load_picard():
+    """
+    Import the skill from the root of the repository, the way opsdroid does.
+    """
+    spec = importlib.util.spec_from_file_location("picard_skill", ROOT / "__init__.py",
+                                                  submodule_search_locations=[str(ROOT)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module.Picard
+
+
+def picard_config(args):
+    config = {
+        'name': "picard",
+        'slack_bot_token': "xoxb-bench",
+        'slack_user_token': "xoxp-bench",
+        'appservice_bot_mxid': f"@slackbot:{SERVER_NAME}",
+        'slack_bot_name': "picard",
+        'room_alias_templates': ["#bench_{name}:" + SERVER_NAME],
+        'room_name_template': "Bench {name}",
+        'announcement_room_name': "channel-0",
+        'users_as_admin': [ADMIN],
+        'copy_from_slack_startup': True,
+        'provision_in_one_request': args.provision_in_one_request,
+        'community_id': COMMUNITY_ID,
+        'welcome': {'matrix': "Welcome to the benchmark.",
+                    'slack': "Welcome to the benchmark."},
+    }
+    if not args.production_rate_limits:
+        # Measure picard, not the limits it puts on itself.
+        config['rate_limits'] = {name: 10 ** 6 for name in
+                                 ('matrix', 'matrix.groups', 'slack.tier1', 'slack.tier2',
+                                  'slack.tier3', 'slack.tier4', 'slack.chat')}
+    return config
+
+
+class Workspace:
+    """
+    The fake servers, opsdroid and picard for one workspace size.
+    """
+    def __init__(self, size, args):
+        self.size = size
+        self.args = args
+        self.matrix = FakeMatrixServer(SERVER_NAME,
+                                       aliases=("picard", "bridge"),
+                                       community_id=COMMUNITY_ID,
+                                       community_users=size,
+                                       community_rooms=size,
+                                       bridge_bot=f"@slackbot:{SERVER_NAME}",
+                                       bridge_room="bridge",
+                                       latency=args.latency,
+                                       rate_limit=args.matrix_rate_limit)
+        self.slack = FakeSlackAPI(channels=size,
+                                  users=size,
+                                  latency=args.latency,
+                                  rate_limit=args.slack_rate_limit)
+        self.opsdroid = None
+        self.picard = None
+        self._listener = None
+
+    async def start(self):
+        await self.matrix.start()
+        await self.slack.start()
+        slack_api_url = f"{self.slack.url}/api/"
+
+        # Entering opsdroid makes it the instance events respond through.
+        self.opsdroid = OpsDroid(config={}).__enter__()
+        self.opsdroid.memory.databases = [MemoryDatabase(opsdroid=self.opsdroid)]
+
+        matrix_connector = ConnectorMatrix({'name': "matrix",
+                                            'mxid': f"@picard:{SERVER_NAME}",
+                                            'password': "bench",
+                                            'homeserver': self.matrix.url,
+                                            'rooms': {'main': f"#picard:{SERVER_NAME}",
+                                                      'bridge': f"#bridge:{SERVER_NAME}"}},
+                                           opsdroid=self.opsdroid)
+        slack_connector = ConnectorSlack({'name': "slack",
+                                          'api-token': "xoxb-bench",
+                                          'token': "xoxb-bench",
+                                          'bot-name': "picard"},
+                                         opsdroid=self.opsdroid)
+        slack_connector.slack.base_url = slack_api_url
+        self.opsdroid.connectors = [matrix_connector, slack_connector]
+
+        # The slack connector is not connected, it would start an RTM session.
+        await matrix_connector.connect()
+
+        Picard = load_picard()
+        self.picard = Picard(self.opsdroid, picard_config(self.args))
+        self.picard.slack_user_client.base_url = slack_api_url
+        self.picard._install_request_scheduler()
+
+        # Register the skill's handlers the way opsdroid's setup_skills does,
+        # so the events the connector receives reach picard.
+        for name in self.picard.__dir__():
+            try:
+                method = getattr(self.picard, name)
+            except Exception:
+                continue
+            if hasattr(method, "skill"):
+                self.opsdroid.skills.append(method)
+
+        # The bridge's replies to admin commands arrive through /sync.
+        self._listener = asyncio.ensure_future(matrix_connector.listen())
+
+    async def stop(self):
+        # The listener and picard's createroom workers run until they are cancelled.
+        tasks = [self._listener, *self.picard._createroom_workers]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.picard.close_slack_user_client()
+        await self.opsdroid.connectors[0].disconnect()
+        await self.matrix.stop()
+        await self.slack.stop()
+        self.opsdroid.__exit__(None, None, None)
+
+    @property
+    def matrix_connector(self):
+        return self.opsdroid.connectors[0]
+
+    def command(self, text, sender=ADMIN, target=None, pattern=None):
+        """
+        A message as opsdroid would pass it to the skill.
+        """
+        message = Message(text,
+                          user=sender,
+                          target=target or self.matrix_connector.room_ids['main'],
+                          connector=self.matrix_connector,
+                          raw_event={'sender': sender})
+        if pattern:
+            message.regex = re.match(pattern, text)
+        return message
+
+    # The benchmarks
+
+    async def bridgeall(self):
+        await self.picard.bridge_all_slack_channels(self.command("!bridgeall"))
+
+    async def createroom(self):
+        for i in range(self.args.createroom_count):
+            await self.picard.on_create_room_command(self.command(
+                f"!createroom bench-{i} A room made by the benchmark",
+                pattern=r"!createroom (?P<name>[^\s]+)( (?P<topic>.+))?"))
+        # The rooms are created in the background.
+        await self.picard._createroom_queue.join()
+
+    async def welcomeall(self):
+        await self.picard.on_welcome_all(self.command("!welcomeall"))
+
+    async def inviteall(self):
+        user = f"@user0:{SERVER_NAME}"
+        await self.picard.on_invite_all(self.command("!inviteall", sender=user))
+
+    async def watch_new_users(self):
+        # One poll of the community watcher, with every user being new.
+        await self.picard._poll_community_users()
+
+    async def prepare_welcomeall(self):
+        # Give every community user a DM room with the bot.
+        direct_messages = {}
+        for i in range(self.size):
+            room_id = self.matrix._new_room(creator=self.matrix_connector.mxid)
+            direct_messages[f"@user{i}:{SERVER_NAME}"] = room_id
+        await self.picard._direct_messages.update(direct_messages)
+
+
+def report(name, size, elapsed, workspace):
+    matrix_calls, slack_calls = workspace.matrix.calls, workspace.slack.calls
+    rate_limited = (sum(workspace.matrix.rate_limited.values()) +
+                    sum(workspace.slack.rate_limited.values()))
+    print(f"{name:>16} {size:>7} {elapsed:>10.2f}s "
+          f"{sum(matrix_calls.values()):>12} {sum(slack_calls.values()):>11} {rate_limited:>6}")
+    if workspace.args.verbose:
+        for service, calls in (("matrix", matrix_calls), ("slack", slack_calls)):
+            for operation, count in calls.most_common():
+                print(f"{'':>16} {service:>7} {operation:<40} {count}")
+
+
+async def run_size(size, args):
+    workspace = Workspace(size, args)
+    await workspace.start()
+    try:
+        for name in args.benchmarks:
+            prepare = getattr(workspace, f"prepare_{name}", None)
+            if prepare:
+                await prepare()
+
+            workspace.matrix.reset_counts()
+            workspace.slack.reset_counts()
+            start = time.perf_counter()
+            await getattr(workspace, name)()
+            elapsed = time.perf_counter() - start
+            report(name, size, elapsed, workspace)
+    finally:
+        await workspace.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000],
+                        help="The numbers of channels, users and community rooms to "
+                        "benchmark with.")
+    parser.add_argument("--benchmarks", nargs="+", default=list(BENCHMARKS), choices=BENCHMARKS,
+                        help="The operations to benchmark, in order. Later ones use the rooms "
+                        "bridgeall creates.")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds the fake servers wait before every response.")
+    parser.add_argument("--matrix-rate-limit", type=float, default=None,
+                        help="Requests per second the fake homeserver allows.")
+    parser.add_argument("--slack-rate-limit", type=float, default=None,
+                        help="Requests per second the fake slack API allows.")
+    parser.add_argument("--createroom-count", type=int, default=10,
+                        help="How many rooms the createroom benchmark creates.")
+    parser.add_argument("--provision-in-one-request", action="store_true",
+                        help="Set picard's provision_in_one_request option.")
+    parser.add_argument("--production-rate-limits", action="store_true",
+                        help="Keep picard's own default rate limits.")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="Show the calls made to each API endpoint.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    # opsdroid expects its command line to have installed _ for translations.
+    gettext.install("opsdroid")
+    print(f"{'benchmark':>16} {'size':>7} {'wall time':>11} "
+          f"{'matrix calls':>12} {'slack calls':>11} {'429s':>6}")
+    for size in args.sizes:
+        asyncio.get_event_loop().run_until_complete(run_size(size, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""
+Sending commands to the admin room of the slack appservice and waiting for its replies.
+"""
+import asyncio
+import logging
+from collections import deque
+
+_LOGGER = logging.getLogger(__name__)
+
+__all__ = ['BridgeCommandChannel', 'BridgeCommandError']
+
+
+class BridgeCommandError(Exception):
+    """
+    The bridge replied to a command with an error, or did not reply at all.
+    """
+
+
+class _PendingCommand:
+    """
+    A command sent to the bridge, waiting for its reply.
+    """
+    __slots__ = ('name', 'terminal_replies', 'future', 'expired_at')
+
+    def __init__(self, name, terminal_replies, future):
+        self.name = name
+        self.terminal_replies = terminal_replies
+        self.future = future
+        self.expired_at = None
+
+    @property
+    def expired(self):
+        return self.expired_at is not None
+
+    def is_reply(self, text):
+        """
+        Is this a reply which ends this command.
+        """
+        return self.terminal_replies is None or text.startswith(self.terminal_replies)
+
+    def expire(self, now):
+        """
+        Stop waiting for the reply, but keep the place of this command in line.
+        """
+        if not self.future.done():
+            self.future.cancel()
+            self.expired_at = now
+
+
+class BridgeCommandChannel:
+    """
+    Pipeline commands to the bridge admin room, with up to ``window`` of them
+    waiting for a reply at once.
+
+    The appservice answers admin commands in order, but its replies do not
+    say which command they answer and some commands get more than one
+    notice. A command is only answered by a notice which can end it (see
+    ``terminal_replies``), which goes to the oldest command it can end;
+    other notices are ignored. A command without a reply after ``timeout``
+    seconds fails, but keeps its place so that a late reply is recognised as
+    one, until a later command is answered or it has waited another
+    ``timeout`` seconds. Commands are only sent again, up to ``retries``
+    times, when sending them fails.
+    """
+    error_prefixes = ("Command failed", "Unrecognised command", "Cannot", "Failed")
+
+    # How the last reply to each command starts, replies to other commands
+    # can be ended by anything.
+    terminal_replies = {
+        'link': ("Room is now", "Cannot link"),
+        'unlink': ("Unlinked", "Cannot unlink"),
+        'leave': ("Drained",),
+    }
+    # Any command can end with the bridge failing to run it.
+    failed_replies = ("Command failed", "Unrecognised command")
+    # Notices sent after the reply to a command, which never end one.
+    follow_up_replies = ("Remember to invite the slack bot", "Inbound URL is")
+
+    def __init__(self, send, window=5, timeout=30, retries=2):
+        self._send = send
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self._semaphore = asyncio.Semaphore(window)
+        self._in_flight = deque()
+        self._waiting = 0
+
+    @property
+    def queue_depth(self):
+        """
+        The number of commands waiting for a free slot in the window.
+        """
+        return self._waiting
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def _drop_expired(self, now):
+        """
+        Forget the timed out commands which have waited long enough that
+        their reply is not coming.
+        """
+        for pending in list(self._in_flight):
+            if pending.expired and now - pending.expired_at >= self.timeout:
+                _LOGGER.warning(f"Giving up on a reply from the bridge to {pending.name}.")
+                self._in_flight.remove(pending)
+
+    def _pending_command(self, name, loop):
+        terminal_replies = self.terminal_replies.get(name)
+        if terminal_replies is not None:
+            terminal_replies = terminal_replies + self.failed_replies
+        return _PendingCommand(name, terminal_replies, loop.create_future())
+
+    async def run(self, command):
+        """
+        Send a command, returning the bridge's reply.
+        """
+        # Only log the command's name, the arguments can include tokens.
+        name = command.split(' ', 1)[0]
+        loop = asyncio.get_event_loop()
+
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        try:
+            for attempt in range(self.retries + 1):
+                self._drop_expired(loop.time())
+                pending = self._pending_command(name, loop)
+                self._in_flight.append(pending)
+                try:
+                    await self._send(command)
+                except asyncio.CancelledError:
+                    pending.expire(loop.time())
+                    raise
+                except Exception:
+                    # The command never reached the room, so no reply is coming.
+                    self._in_flight.remove(pending)
+                    if attempt == self.retries:
+                        raise
+                    _LOGGER.exception(f"Failed to send {name} to the bridge, "
+                                      f"attempt {attempt + 1} of {self.retries + 1}.")
+                    continue
+                break
+
+            try:
+                reply = await asyncio.wait_for(asyncio.shield(pending.future), self.timeout)
+            except asyncio.TimeoutError:
+                raise BridgeCommandError(
+                    f"The bridge did not reply to {name} within {self.timeout} seconds.")
+            finally:
+                pending.expire(loop.time())
+
+            if reply.startswith(self.error_prefixes):
+                raise BridgeCommandError(f"The bridge replied to {name} with: {reply}")
+            return reply
+        finally:
+            self._semaphore.release()
+
+    def reply(self, text):
+        """
+        Pass on a message from the bridge to the oldest command it can end.
+        """
+        self._drop_expired(asyncio.get_event_loop().time())
+        if text.startswith(self.follow_up_replies):
+            _LOGGER.debug(f"Got a follow up message from the bridge: {text}")
+            return False
+
+        # Commands still waiting come first, so a lost reply only fails its own command.
+        candidates = [p for p in self._in_flight if p.is_reply(text)]
+        pending = next((p for p in candidates if not p.expired), None)
+        if pending is None and candidates:
+            pending = candidates[0]
+        if pending is None:
+            _LOGGER.debug(f"Got a message from the bridge which is not a reply to a command: "
+                          f"{text}")
+            return False
+
+        # The bridge answers in order, so the timed out commands before this
+        # one are not getting a reply any more.
+        position = self._in_flight.index(pending)
+        self._in_flight = deque(
+            p for i, p in enumerate(self._in_flight)
+            if i > position or (i < position and not p.expired))
+
+        if pending.expired:
+            _LOGGER.warning(f"Got a late reply from the bridge to {pending.name}: {text}")
+            return False
+
+        pending.future.set_result(text)
+        return True
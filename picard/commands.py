@@ -1,5 +1,7 @@
 import asyncio
 import logging
+import uuid
+from copy import deepcopy
 from textwrap import dedent
 
 from markdown import markdown
@@ -10,6 +12,9 @@ from opsdroid.events import (JoinRoom, Message, NewRoom, OpsdroidStarted,
 from opsdroid.matchers import match_regex
 
 from .constraints import admin_command, ignore_appservice_users
+from .metrics import timed
+from .ratelimit import INTERACTIVE, interactive, request_priority
+from .util import aiterate, run_in_pool
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -17,6 +22,7 @@ _LOGGER = logging.getLogger(__name__)
 class PicardCommands:
     @match_regex("!help")
     @ignore_appservice_users
+    @interactive
     async def on_help(self, message):
         help_text = dedent(f"""\
         Hi {message.user}! Here are the commands you can use in the chat.
@@ -54,29 +60,40 @@ class PicardCommands:
     @constrain_connectors("matrix")
     @ignore_appservice_users
     async def on_invite_all(self, message):
-        await message.respond("Inviting you to all rooms...")
-        rooms = await self.get_all_community_rooms()
-        for r in rooms:
-            # If the room is archived don't invite people to it.
-            # with self.memory[r]:
-            #     archived = await self.opsdroid.memory.get("is_archived")
-            #     _LOGGER.debug(f"Room {r} reports archived is {archived}")
-            #     if archived:
-            #         continue
-            await message.respond(UserInvite(user=message.raw_event['sender'],
-                                             target=r,
-                                             connector=self.matrix_connector))
+        sender = message.raw_event['sender']
+        rooms = await self.get_all_community_rooms() or []
+
+        # Don't invite people to archived rooms or rooms they are already in.
+        await self.backfill_archived_rooms(rooms)
+        rooms = [r for r in rooms if r not in self._archived_rooms]
+
+        await message.respond(f"Inviting you to the rooms you are not in yet, "
+                              f"out of {len(rooms)} rooms...")
+
+        invited = []
+
+        async def invite(matrix_room_id):
+            if sender in await self.get_joined_member_ids(matrix_room_id):
+                return
+            await self.opsdroid.send(UserInvite(user_id=sender,
+                                                target=matrix_room_id,
+                                                connector=self.matrix_connector))
+            invited.append(matrix_room_id)
+
+        failures = await run_in_pool(invite, rooms, self.config.get("invite_concurrency", 10))
+        await message.respond(f"Invited you to {len(invited)} rooms.")
+        if failures:
+            await message.respond(f"Failed to invite you to {len(failures)} rooms.")
 
     @match_regex("!autoinvite")
     @constrain_connectors("matrix")
     @ignore_appservice_users
     async def on_auto_invite(self, message):
         sender = message.raw_event['sender']
-        users = await self.opsdroid.memory.get("autoinvite_users") or []
-        if sender in users:
+        await self._autoinvite_users.load()
+        if sender in self._autoinvite_users:
             return await message.respond("You already have autoinvite enabled.")
-        users.append(sender)
-        await self.opsdroid.memory.put("autoinvite_users", users)
+        await self._autoinvite_users.add(sender)
 
         return await message.respond(
             "You will be invited to all future rooms. Use !inviteall to get invites to existing rooms.")
@@ -86,95 +103,297 @@ class PicardCommands:
     @ignore_appservice_users
     async def on_disable_auto_invite(self, message):
         sender = message.raw_event['sender']
-        users = await self.opsdroid.memory.get("autoinvite_users") or []
-        if sender not in users:
+        await self._autoinvite_users.load()
+        if sender not in self._autoinvite_users:
             return await message.respond("You do not have autoinvite enabled.")
-        users.remove(sender)
-        await self.opsdroid.memory.put("autoinvite_users", users)
+        await self._autoinvite_users.discard(sender)
 
         return await message.respond("Autoinvite disabled.")
 
     @match_regex(r"!createroom (?P<name>[^\s]+)( (?P<topic>.+))?")
     @ignore_appservice_users
+    @interactive
+    @timed
     async def on_create_room_command(self, message):
-        await message.respond('Creating room please wait, this takes a little while...')
-
+        """
+        Queue a job to create the room, so the command returns straight away.
+        """
         name, topic = (message.regex['name'],
                        message.regex['topic'])
 
-        is_public = self.config.get("make_public", False)
-        matrix_room_id = await self.create_new_matrix_room()
-
-        await self.configure_new_matrix_room_pre_bridge(matrix_room_id, is_public)
-
-        async with self._slack_channel_lock:
-            # Create the corresponding slack channel
-            slack_channel_id = await self.create_slack_channel(name)
-
-            # Just to make sure we get the slack new room event
-            await asyncio.sleep(0.1)
-
-        # Link the two rooms
-        await self.link_room(matrix_room_id, slack_channel_id)
-
-        # Setup the matrix room
-        matrix_room_alias = await self.configure_new_matrix_room_post_bridge(
-            matrix_room_id, name, topic)
-
-        # Set the description of the slack channel
-        if topic:
-            await self.set_slack_channel_description(slack_channel_id, topic)
-
-        # Invite Command User
         if message.connector is self.matrix_connector:
-            user = message.raw_event['sender']
-            target = matrix_room_id
-            command_room = message.target
-
-            await self.opsdroid.send(UserInvite(target=target,
-                                                user=user,
-                                                connector=message.connector))
-
-        elif message.connector is self.slack_connector:
-            user = message.raw_event['user']
-            target = slack_channel_id
-            command_room = await self.matrix_room_id_from_slack_channel_name(message.target)
+            user_id = message.raw_event['sender']
+        else:
+            user_id = message.raw_event['user']
+
+        job = {'id': uuid.uuid4().hex[:8],
+               'name': name,
+               'topic': topic,
+               'connector': message.connector.name,
+               'user': message.user,
+               'user_id': user_id,
+               'command_target': message.target,
+               'steps_done': []}
+        await self._save_createroom_job(job)
+        await self._queue_createroom_job(job['id'])
+
+        await message.respond(f"Creating room {name} (job {job['id']}), "
+                              "I will let you know when it is ready...")
+
+        return job['id']
+
+    async def _queue_createroom_job(self, job_id):
+        """
+        Queue a createroom job, starting the workers if they are not running.
+        """
+        if self._createroom_queue is None:
+            self._createroom_queue = asyncio.Queue()
+            self._createroom_workers = [
+                asyncio.ensure_future(self._createroom_worker())
+                for _ in range(self.config.get("createroom_concurrency", 2))]
+
+        await self._createroom_queue.put(job_id)
+
+    async def resume_createroom_jobs(self):
+        """
+        Queue the createroom jobs which had not finished when picard stopped.
+        """
+        await self._createroom_jobs.load()
+        for job_id, job in self._createroom_jobs.items():
+            if job.get('failed'):
+                _LOGGER.info(f"Not resuming failed createroom job {job_id} for {job['name']}, "
+                             f"run !retrycreateroom {job_id} to retry it.")
+                continue
+            _LOGGER.info(f"Resuming createroom job {job_id} for {job['name']} "
+                         f"after {job['steps_done'][-1:] or 'no steps'}.")
+            await self._queue_createroom_job(job_id)
+
+    async def _save_createroom_job(self, job):
+        # Store a copy, so later changes to the job are seen as changes.
+        await self._createroom_jobs.set(job['id'], deepcopy(job))
+
+    @match_regex(r"!retrycreateroom (?P<job_id>\w+)")
+    @admin_command
+    @ignore_appservice_users
+    async def on_retry_create_room(self, message):
+        """
+        Queue a failed createroom job again, it carries on after its last finished step.
+        """
+        job_id = message.regex['job_id']
+        job = deepcopy(self._createroom_jobs.get(job_id))
+        if job is None or not job.get('failed'):
+            return await message.respond(f"There is no failed createroom job {job_id}.")
+
+        job['failed'] = False
+        await self._save_createroom_job(job)
+        await self._queue_createroom_job(job_id)
+        return await message.respond(f"Retrying createroom job {job_id} for {job['name']}.")
+
+    async def _createroom_worker(self):
+        while True:
+            job_id = await self._createroom_queue.get()
+            try:
+                await self._process_createroom_job(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Keep the worker alive, otherwise the queue stops being processed.
+                _LOGGER.exception(f"Createroom worker failed to process job {job_id}.")
+            finally:
+                self._createroom_queue.task_done()
+
+    async def _process_createroom_job(self, job_id):
+        job = deepcopy(self._createroom_jobs.get(job_id))
+        if job is None:
+            return
 
-            await self.invite_user_to_slack_channel(slack_channel_id, user)
+        try:
+            with request_priority(INTERACTIVE):
+                with self._metrics.time("picard_pipeline_seconds", pipeline="createroom_job"):
+                    await self._run_createroom_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            _LOGGER.exception(f"Createroom job {job_id} failed.")
+            # Keep the job, so the half configured room can be inspected or the job retried.
+            job['failed'] = True
+            await self._save_createroom_job(job)
+            await self._send_to_command_room(
+                job, f"Sorry, creating the room {job['name']} (job {job_id}) failed "
+                f"after {job['steps_done'][-1:] or 'no steps'}.")
+            return
 
-        # Inform users about the new room/channel
-        pill = f'<a href="https://matrix.to/#/{matrix_room_alias}">{matrix_room_alias}</a>'
-        await self.opsdroid.send(Message(f"Created a new room: {pill}",
-                                         target=command_room,
-                                         connector=self.matrix_connector))
+        await self._createroom_jobs.pop(job_id)
+
+    async def _send_to_command_room(self, job, text):
+        """
+        Reply to the createroom command, where it was sent.
+        """
+        connector = self.opsdroid._connector_names[job['connector']]
+        await self.opsdroid.send(Message(text, target=job['command_target'], connector=connector))
+
+    async def _run_createroom_job(self, job):
+        """
+        Run the steps of a createroom job, skipping those already done.
+
+        The job is saved after every step, so if picard restarts it carries
+        on from the last step which finished.
+        """
+        name, topic = job['name'], job['topic']
+        provision_in_one_request = self.config.get("provision_in_one_request", False)
+
+        async def step(step_name, func):
+            if step_name in job['steps_done']:
+                return
+            await func()
+            job['steps_done'].append(step_name)
+            await self._save_createroom_job(job)
+
+        async def create_matrix_room():
+            is_public = self.config.get("make_public", False)
+            job['matrix_room_id'] = await self.create_new_matrix_room()
+            await self.configure_new_matrix_room_pre_bridge(job['matrix_room_id'], is_public)
+
+        async def create_slack_channel():
+            async with self._slack_channel_lock:
+                # Create the corresponding slack channel
+                job['slack_channel_id'] = await self.create_slack_channel(name)
+
+                # Just to make sure we get the slack new room event
+                await asyncio.sleep(0.1)
+
+        async def create_bridged_matrix_room():
+            # Create, configure and link the matrix room
+            job['matrix_room_id'], job['matrix_room_alias'] = \
+                await self.create_bridged_matrix_room(name, topic, job['slack_channel_id'])
+
+        async def link_rooms():
+            await self.link_room(job['matrix_room_id'], job['slack_channel_id'])
+
+        async def configure_matrix_room():
+            job['matrix_room_alias'] = await self.configure_new_matrix_room_post_bridge(
+                job['matrix_room_id'], name, topic)
+
+        async def set_slack_topic():
+            if topic:
+                await self.set_slack_channel_description(job['slack_channel_id'], topic)
+
+        async def invite_user():
+            if job['connector'] == self.matrix_connector.name:
+                await self.opsdroid.send(UserInvite(target=job['matrix_room_id'],
+                                                    user_id=job['user_id'],
+                                                    connector=self.matrix_connector))
+            else:
+                await self.invite_user_to_slack_channel(job['slack_channel_id'], job['user_id'])
+
+        async def announce():
+            if job['connector'] == self.matrix_connector.name:
+                command_room = job['command_target']
+            else:
+                command_room = await self.matrix_room_id_from_slack_channel_name(
+                    job['command_target'])
+
+            # Inform users about the new room/channel
+            matrix_room_alias = job['matrix_room_alias']
+            pill = f'<a href="https://matrix.to/#/{matrix_room_alias}">{matrix_room_alias}</a>'
+            await self.opsdroid.send(Message(f"Created a new room: {pill}",
+                                             target=command_room,
+                                             connector=self.matrix_connector))
 
-        await self.announce_new_room(matrix_room_alias, message.user, topic)
+            await self.announce_new_room(matrix_room_alias, job['user'], topic)
 
-        if message.connector is self.slack_connector:
-            await message.respond("New room created, you should have been invited to it.")
+            if job['connector'] == self.slack_connector.name:
+                await self._send_to_command_room(
+                    job, "New room created, you should have been invited to it.")
 
-        return matrix_room_id
+        if provision_in_one_request:
+            await step("slack_channel", create_slack_channel)
+            await step("matrix_room", create_bridged_matrix_room)
+        else:
+            await step("matrix_room", create_matrix_room)
+            await step("slack_channel", create_slack_channel)
+            await step("link", link_rooms)
+            await step("configure", configure_matrix_room)
+        await step("slack_topic", set_slack_topic)
+        await step("invite", invite_user)
+        await step("announce", announce)
 
     @match_regex('!welcomeall')
     @admin_command
     @ignore_appservice_users
     async def on_welcome_all(self, message):
         """Send the appropriate welcome message to all current users"""
-        import slack
-
         await message.respond("Sending out welcome messages.")
-        slack_users = await self.get_all_slack_users()
-        for user in slack_users:
-            try:
-                await self.send_slack_welcome_message(user)
-            except slack.errors.SlackApiError:
-                _LOGGER.exception(f"Failed to send welcome message to {user}")
-
-        # Get list of all matrix-side users from memory
-        matrix_dms = await self.opsdroid.memory.get("direct_messages")
-        matrix_dms = matrix_dms or {}
-        for user, matrix_room_id in matrix_dms.items():
-            await self.send_matrix_welcome_message(matrix_room_id)
+        concurrency = self.config.get("welcome_concurrency", 10)
+        welcome = self.config.get('welcome', {})
+        summary = []
+
+        if welcome.get('slack'):
+            async def slack_users():
+                async for user in self.iter_slack_users():
+                    self.update_slack_user(user)
+                    yield user['id']
+
+            sent, failed, skipped = await self._welcome_all(slack_users(),
+                                                            self._welcomed_slack_users,
+                                                            self.send_slack_welcome_message,
+                                                            concurrency)
+            summary.append(f"slack: {sent} sent, {failed} failed, {skipped} already welcomed")
+
+        if welcome.get('matrix'):
+            # Get list of all matrix-side users from memory
+            matrix_dms = self._direct_messages
+            await matrix_dms.load()
+
+            async def send_matrix_welcome_message(user):
+                await self.send_matrix_welcome_message(matrix_dms[user])
+
+            sent, failed, skipped = await self._welcome_all(matrix_dms,
+                                                            self._welcomed_matrix_users,
+                                                            send_matrix_welcome_message,
+                                                            concurrency)
+            summary.append(f"matrix: {sent} sent, {failed} failed, {skipped} already welcomed")
+
+        await message.respond("Finished sending welcome messages. " + "; ".join(summary))
+
+    async def _welcome_all(self, users, welcomed_users, send_welcome_message, concurrency):
+        """
+        Send welcome messages to all the users who have not been welcomed yet.
+
+        Rate limited sends are retried after the delay the server asks for.
+        Returns the number of messages sent, failed and skipped.
+        """
+        await welcomed_users.load()
+        counts = {'queued': 0, 'skipped': 0}
+        sent = []
+
+        async def to_welcome():
+            async for user in aiterate(users):
+                if user in welcomed_users:
+                    counts['skipped'] += 1
+                    continue
+                counts['queued'] += 1
+                yield user
+
+        async def record_welcome(user, error):
+            if error is None:
+                sent.append(user)
+            # Save progress in batches, so a restart doesn't welcome people twice.
+            if len(sent) >= 100:
+                batch = sent[:]
+                sent.clear()
+                await welcomed_users.update(batch)
+
+        failures = await run_in_pool(send_welcome_message,
+                                     to_welcome(),
+                                     concurrency,
+                                     on_complete=record_welcome)
+        await welcomed_users.update(sent)
+
+        for user, error in failures:
+            _LOGGER.error(f"Failed to send welcome message to {user}: {error}")
+
+        return counts['queued'] - len(failures), len(failures), counts['skipped']
 
     @match_regex(r"!skip (?P<flag>\w+)")
     @constrain_connectors("matrix")
@@ -201,12 +420,15 @@ class PicardCommands:
         if flag not in flags:
             await message.respond(f"The skip argument must be one of {flags}, not {flag}")
 
-        with self.memory[matrix_room_id]:
-            options = await self.opsdroid.memory.get("picard.options") or {}
+        options = await self.memory.get("picard.options", room=matrix_room_id) or {}
 
         options.update({f"skip_room_{flag}": skip})
 
-        with self.memory[matrix_room_id]:
-            await self.opsdroid.memory.put("picard.options", options)
+        await self.memory.put("picard.options", options, room=matrix_room_id)
+
+        # Make the next bridgeall configure this room again.
+        slack_channel_id = await self._bridged_rooms.slack_channel_id(matrix_room_id)
+        if slack_channel_id:
+            await self._channel_fingerprints.pop(slack_channel_id)
 
         await message.respond("Your room settings have been updated.")
@@ -1,13 +1,56 @@
+import asyncio
 import logging
+from copy import deepcopy
+from urllib.parse import quote
 
 from matrix_client.errors import MatrixRequestError
 
 from opsdroid.events import *
 from opsdroid.connector.matrix.events import *
+from opsdroid.matchers import match_event
+
+from .constraints import constrain_matrix_connector
 
 _LOGGER = logging.getLogger(__name__)
 
 
+class PowerLevelChanges:
+    """
+    A collection of changes to make to a room's m.room.power_levels state, so
+    they can all be sent as one state event.
+    """
+    def __init__(self):
+        self._changes = {}
+
+    def set_user_level(self, user_id, level):
+        self._changes[('users', user_id)] = level
+
+    def set_notification_level(self, notification, level):
+        self._changes[('notifications', notification)] = level
+
+    def set_level(self, key, level):
+        """
+        Set a top level key, such as ``events_default``.
+        """
+        self._changes[(key,)] = level
+
+    def __bool__(self):
+        return bool(self._changes)
+
+    def apply(self, power_levels):
+        """
+        Return a copy of the power levels content with the changes made.
+        """
+        power_levels = deepcopy(power_levels)
+        for path, level in self._changes.items():
+            content = power_levels
+            for key in path[:-1]:
+                content = content.setdefault(key, {})
+            content[path[-1]] = level
+
+        return power_levels
+
+
 class MatrixMixin:
     """
     Matrix Operations for Picard.
@@ -15,14 +58,20 @@ class MatrixMixin:
 
     @property
     def matrix_api(self):
-        return self.matrix_connector.connection
+        return self._request_scheduler.install_matrix(self.matrix_connector.connection)
 
     async def room_id_if_exists(self, room_alias):
         """
         Returns the room id if the room exists or `None` if it doesn't.
+
+        Both answers are cached, aliases picard adds or removes itself are
+        looked up again.
         """
         if room_alias.startswith('!'):
             return room_alias
+        return await self._alias_cache.get(room_alias, self._resolve_room_alias)
+
+    async def _resolve_room_alias(self, room_alias):
         try:
             room_id = await self.matrix_api.get_room_id(room_alias)
             return room_id
@@ -31,29 +80,88 @@ class MatrixMixin:
                 raise e
         return None
 
+    async def add_room_alias(self, matrix_room_id, alias):
+        await self.opsdroid.send(RoomAddress(target=matrix_room_id,
+                                             address=alias,
+                                             connector=self.matrix_connector))
+        self._alias_cache.invalidate(alias)
+
+    async def _get_joined_rooms(self):
+        """
+        The set of rooms the bot user is in.
+
+        This is fetched from the server once and then kept up to date from
+        the bot's join events and the joins picard makes itself. opsdroid
+        does not emit leave events, so a room the bot is removed from stays
+        in the set until picard is restarted.
+        """
+        if self._joined_rooms is None:
+            async with self._joined_rooms_lock:
+                if self._joined_rooms is None:
+                    respjson = await self.matrix_api._send("GET", "/joined_rooms")
+                    self._joined_rooms = set(respjson['joined_rooms'])
+
+        return self._joined_rooms
+
+    def _set_joined_matrix_room(self, matrix_room_id):
+        """
+        Record that the bot user has joined a room.
+
+        If the joined rooms have not been fetched yet there is nothing to update.
+        """
+        if self._joined_rooms is not None:
+            self._joined_rooms.add(matrix_room_id)
+
     async def is_in_matrix_room(self, matrix_room_id):
         """
         Is the bot user in the matrix room.
         """
-        respjson = await self.matrix_api._send("GET", "/joined_rooms")
-        joined_rooms = respjson['joined_rooms']
+        return matrix_room_id in await self._get_joined_rooms()
+
+    async def _load_joined_member_ids(self, matrix_room_id):
+        respjson = await self.matrix_api._send(
+            "GET", f"/rooms/{quote(matrix_room_id)}/joined_members")
+        return set(respjson['joined'])
+
+    async def get_joined_member_ids(self, matrix_room_id):
+        """
+        The set of users in the matrix room.
 
-        return matrix_room_id in joined_rooms
+        This is fetched from the server the first time it is needed and then
+        kept up to date from join events. opsdroid does not emit leave events,
+        so it is fetched again ``room_members_cache_ttl`` seconds later.
+        """
+        return await self._room_members.get(matrix_room_id, self._load_joined_member_ids)
+
+    @match_event(JoinRoom)
+    @constrain_matrix_connector
+    async def on_matrix_room_join(self, join):
+        members = self._room_members.peek(join.target)
+        if members is not None:
+            members.add(join.user_id)
+        if join.user_id == self.matrix_connector.mxid:
+            self._set_joined_matrix_room(join.target)
+
+    async def matrix_room_id_from_aliases(self, name):
+        """
+        Test all configured aliases to see if this room exists, returning the
+        room id of the first match or `None`.
+
+        The aliases are all looked up at the same time.
+        """
+        room_alias_templates = self.config.get('room_alias_templates', [])
+        matrix_room_ids = await asyncio.gather(*[
+            self.room_id_if_exists(alias_template.format(name=name))
+            for alias_template in room_alias_templates])
+
+        return next(filter(None, matrix_room_ids), None)
 
     async def join_or_create_matrix_room(self, name):
         """
         Test all configured aliases to see if this room exists, if it dosen't
         then make a new room.
         """
-
-        alias = None
-        room_alias_templates = self.config.get('room_alias_templates', [])
-        for alias_template in room_alias_templates:
-            alias = alias_template.format(name=name)
-            matrix_room_id = await self.room_id_if_exists(alias)
-            # If we find a match stop looking
-            if matrix_room_id:
-                break
+        matrix_room_id = await self.matrix_room_id_from_aliases(name)
 
         if matrix_room_id is None:
             matrix_room_id = await self.create_new_matrix_room()
@@ -63,6 +171,7 @@ class MatrixMixin:
         if not is_in_room:
             await self.opsdroid.send(JoinRoom(target=matrix_room_id,
                                               connector=self.matrix_connector))
+            self._set_joined_matrix_room(matrix_room_id)
 
         return matrix_room_id
 
@@ -72,9 +181,81 @@ class MatrixMixin:
         """
         # Create Room
         matrix_room_id = await self.opsdroid.send(NewRoom())
+        self._set_joined_matrix_room(matrix_room_id)
 
         return matrix_room_id
 
+    async def provision_new_matrix_room(self, name, topic, is_public, invite_users=()):
+        """
+        Create a new matrix room, configured as picard's config says, in one
+        createRoom request.
+
+        This sets everything configure_new_matrix_room_pre_bridge and
+        configure_new_matrix_room_post_bridge would, apart from adding the
+        room to the community. Only aliases which are not on the bot's own
+        server need a request of their own afterwards.
+
+        Returns the room id and the canonical alias.
+        """
+        initial_state = []
+        content = {'preset': 'private_chat',
+                   'invite': list(dict.fromkeys(invite_users)),
+                   'initial_state': initial_state}
+
+        if is_public:
+            initial_state.append({'type': 'm.room.join_rules',
+                                  'content': {'join_rule': 'public'}})
+            initial_state.append({'type': 'm.room.history_visibility',
+                                  'content': {'history_visibility': 'world_readable'}})
+
+        room_name_template = self.config.get('room_name_template')
+        if room_name_template:
+            content['name'] = room_name_template.format(name=name)
+
+        if topic:
+            content['topic'] = topic
+
+        url = self.config.get("room_avatar_url")
+        if url:
+            initial_state.append({'type': 'm.room.avatar', 'content': {'url': url}})
+
+        groups = self._related_groups()
+        if groups:
+            initial_state.append({'type': 'm.room.related_groups',
+                                  'content': {'groups': groups}})
+
+        power_levels = {'users': {self.matrix_connector.mxid: 100}}
+        content['power_level_content_override'] = self._config_power_level_changes().apply(
+            power_levels)
+
+        # The server can only create the first alias for us if it is one of its own.
+        aliases = [t.format(name=name) for t in self.config.get('room_alias_templates', [])]
+        server_name = self.matrix_connector.mxid.split(':', 1)[1]
+        alias_created = False
+        if aliases:
+            localpart, alias_server = aliases[0][1:].split(':', 1)
+            if alias_server == server_name:
+                content['room_alias_name'] = localpart
+                alias_created = True
+
+        resp = await self.matrix_api._send("POST", "/createRoom", content)
+        matrix_room_id = resp['room_id']
+        self._set_joined_matrix_room(matrix_room_id)
+        if alias_created:
+            self._alias_cache.invalidate(aliases[0])
+
+        for alias in aliases[1:] if alias_created else aliases:
+            await self.add_room_alias(matrix_room_id, alias)
+
+        canonical_alias = aliases[0] if aliases else None
+        if aliases and not alias_created:
+            await self.opsdroid.send(MatrixStateEvent("m.room.canonical_alias",
+                                                      content={'alias': canonical_alias},
+                                                      target=matrix_room_id,
+                                                      connector=self.matrix_connector))
+
+        return matrix_room_id, canonical_alias
+
     async def create_new_matrix_direct_message(self, mxid):
         content = {'is_direct': True,
                    'invite': [mxid],
@@ -83,6 +264,7 @@ class MatrixMixin:
         resp = await self.matrix_api._send("POST",
                                            "/createRoom",
                                            content)
+        self._set_joined_matrix_room(resp['room_id'])
         return resp['room_id']
 
     async def configure_new_matrix_room_pre_bridge(self, matrix_room_id, is_public):
@@ -94,83 +276,144 @@ class MatrixMixin:
                                                              target=matrix_room_id,
                                                              connector=self.matrix_connector))
 
-    async def configure_room_aliases(self, matrix_room_id, name):
+    async def get_matrix_room_state(self, matrix_room_id):
+        """
+        The current state of a room, as a dict of (event type, state key) to content.
+        """
+        state = await self.matrix_api.get_room_state(matrix_room_id)
+        return {(event['type'], event.get('state_key', '')): event['content'] for event in state}
+
+    async def reconcile_matrix_room_state(self, matrix_room_id, desired_state, current_state=None):
+        """
+        Send the state events needed to make the room match ``desired_state``.
+
+        ``desired_state`` maps event types to the content they should have. An
+        event is only sent if any of those keys differ from the current state.
+        """
+        if current_state is None:
+            current_state = await self.get_matrix_room_state(matrix_room_id)
+
+        for event_type, content in desired_state.items():
+            current_content = current_state.get((event_type, ''), {})
+            if all(current_content.get(key) == value for key, value in content.items()):
+                continue
+
+            _LOGGER.debug(f"Updating {event_type} in {matrix_room_id}")
+            await self.opsdroid.send(MatrixStateEvent(event_type,
+                                                      content=content,
+                                                      target=matrix_room_id,
+                                                      connector=self.matrix_connector))
+
+    async def configure_room_aliases(self, matrix_room_id, name, current_state=None):
+        """
+        Add the configured aliases to the room, and make the first one canonical.
+
+        If the room's current state is given, aliases the room already has are skipped.
+        """
+        known_aliases = set()
+        canonical_content = {}
+        if current_state is not None:
+            for (event_type, _), content in current_state.items():
+                if event_type == "m.room.aliases":
+                    known_aliases.update(content.get('aliases', []))
+            canonical_content = current_state.get(("m.room.canonical_alias", ''), {})
+            known_aliases.update(canonical_content.get('alt_aliases', []))
+            known_aliases.add(canonical_content.get('alias'))
+
         # Set Aliases
         room_alias_templates = self.config.get('room_alias_templates', [])
         for alias_template in room_alias_templates:
-            await self.opsdroid.send(RoomAddress(target=matrix_room_id,
-                                                 address=alias_template.format(name=name),
-                                                 connector=self.matrix_connector))
+            alias = alias_template.format(name=name)
+            if alias in known_aliases:
+                continue
+            await self.add_room_alias(matrix_room_id, alias)
 
+        canonical_alias = None
         if room_alias_templates:
             canonical_alias = room_alias_templates[0].format(name=name)
-            await self.opsdroid.send(MatrixStateEvent("m.room.canonical_alias",
-                                                      content={'alias': canonical_alias},
-                                                      target=matrix_room_id,
-                                                      connector=self.matrix_connector))
+            if canonical_content.get('alias') != canonical_alias:
+                await self.opsdroid.send(MatrixStateEvent("m.room.canonical_alias",
+                                                          content={'alias': canonical_alias},
+                                                          target=matrix_room_id,
+                                                          connector=self.matrix_connector))
 
         return canonical_alias
 
     async def remove_room_aliases(self, name):
         room_alias_templates = self.config.get('room_alias_templates', [])
         for alias_template in room_alias_templates:
-            await self.matrix_api.remove_room_alias(alias_template.format(name=name))
+            alias = alias_template.format(name=name)
+            await self.matrix_api.remove_room_alias(alias)
+            self._alias_cache.invalidate(alias)
 
     async def configure_new_matrix_room_post_bridge(self, matrix_room_id, name, topic,
                                                     _bridgeall=False):
         """
         Given Picard's config, setup the matrix side as appropriate.
+
+        The room's state is read once, and only the events which would change
+        it are sent, so running this again on a configured room is cheap.
         """
-        with self.memory[matrix_room_id]:
-            room_options = await self.opsdroid.memory.get("picard.options") or {}
-            _LOGGER.debug(f"Got picard options {room_options} for room {matrix_room_id}")
+        room_options = await self.memory.get("picard.options", room=matrix_room_id) or {}
+        _LOGGER.debug(f"Got picard options {room_options} for room {matrix_room_id}")
+
+        current_state = await self.get_matrix_room_state(matrix_room_id)
+
+        canonical_alias = await self.configure_room_aliases(matrix_room_id, name, current_state)
 
-        canonical_alias = await self.configure_room_aliases(matrix_room_id, name)
+        desired_state = {}
 
         # Set Room Name
         room_name_template = self.config.get('room_name_template')
-
         if room_name_template and not room_options.get("skip_room_name"):
-            await self.opsdroid.send(RoomName(target=matrix_room_id,
-                                              name=room_name_template.format(name=name),
-                                              connector=self.matrix_connector))
+            desired_state["m.room.name"] = {'name': room_name_template.format(name=name)}
 
         # Set Room Image
         url = self.config.get("room_avatar_url")
         if url and not room_options.get("skip_room_avatar"):
-            await self.opsdroid.send(RoomImage(Image(url=url),
-                                               target=matrix_room_id,
-                                               connector=self.matrix_connector))
+            desired_state["m.room.avatar"] = {'url': url}
 
         # Set Room Description
         if topic and not room_options.get("skip_room_description"):
-            await self.opsdroid.send(RoomDescription(topic, target=matrix_room_id,
-                                                     connector=self.matrix_connector))
+            desired_state["m.room.topic"] = {'topic': topic}
 
-        if not _bridgeall:
-            memory_users = await self.opsdroid.memory.get("autoinvite_users") or []
-        else:
-            memory_users = []
+        # Enable flairs
+        groups = self._related_groups()
+        if groups:
+            desired_state["m.room.related_groups"] = {'groups': groups}
 
-        invite_users = (self.config.get("users_to_invite", []) +
-                        self.config.get('users_as_admin', []) +
-                        memory_users)
+        await self.reconcile_matrix_room_state(matrix_room_id, desired_state, current_state)
 
-        await self.make_matrix_admin_from_config(matrix_room_id)
+        # Make config people admin, and enable @room if configured
+        await self.update_power_levels(matrix_room_id, self._config_power_level_changes(),
+                                       current_state.get(("m.room.power_levels", '')))
 
+        # Only invite people who are not already in (or invited to) the room
+        invite_users = await self.get_users_to_invite(include_autoinvite=not _bridgeall)
+        invite_users = [user for user in invite_users
+                        if current_state.get(("m.room.member", user), {}).get('membership')
+                        not in ('join', 'invite')]
         await self.invite_to_matrix_room(matrix_room_id, invite_users)
 
-        if self.config.get("allow_at_room", False):
-            await self.matrix_atroom_pl_0(matrix_room_id)
-
         # Add to community
         await self.add_room_to_community(matrix_room_id)
 
-        # Enable flairs
-        await self.set_related_groups(matrix_room_id)
-
         return canonical_alias
 
+    async def get_users_to_invite(self, include_autoinvite=True):
+        """
+        The users who should be invited to every new room.
+        """
+        if include_autoinvite:
+            await self._autoinvite_users.load()
+            memory_users = list(self._autoinvite_users)
+        else:
+            memory_users = []
+
+        return (self.config.get("users_to_invite", []) +
+                self.config.get('users_as_admin', []) +
+                memory_users)
+
     async def invite_to_matrix_room(self, matrix_room_id, users):
         """
         Invite the listed users to the room.
@@ -180,45 +423,53 @@ class MatrixMixin:
                                                 user_id=user,
                                                 connector=self.matrix_connector))
 
-    async def make_matrix_admin_from_config(self, matrix_room_id):
+    async def update_power_levels(self, matrix_room_id, changes, power_levels=None):
         """
-        Read the configuration file and make people in the 'users_as_admin'
-        list admin in the room.
+        Apply a set of PowerLevelChanges to a room with one state event.
+
+        The current power levels are fetched unless they are passed in, and
+        nothing is sent if the changes do not alter them.
         """
-        # Make config people admin
-        for user in self.config.get("users_as_admin", []):
-            # TODO: Do this manually so we only inject one state event to make all the admins admin.
-            await self.opsdroid.send(UserRole(target=matrix_room_id,
-                                              user_id=user, role='admin',
-                                              connector=self.matrix_connector))
+        if not changes:
+            return
 
-    async def matrix_atroom_pl_0(self, matrix_room_id):
-        power_levels = await self.matrix_api.get_power_levels(matrix_room_id)
+        if power_levels is None:
+            power_levels = await self.matrix_api.get_power_levels(matrix_room_id)
 
-        notifications = power_levels.get('notifications', {})
-        notifications['room'] = 0
-        power_levels['notifications'] = notifications
+        new_power_levels = changes.apply(power_levels)
+        if new_power_levels == power_levels:
+            _LOGGER.debug(f"Power levels in {matrix_room_id} are already up to date.")
+            return
 
-        return await self.opsdroid.send(MatrixPowerLevels(power_levels,
+        return await self.opsdroid.send(MatrixPowerLevels(new_power_levels,
                                                           target=matrix_room_id,
                                                           connector=self.matrix_connector))
 
+    def _config_power_level_changes(self):
+        """
+        The power level changes picard's config asks for in every room.
+        """
+        changes = PowerLevelChanges()
+        for user in self.config.get("users_as_admin", []):
+            changes.set_user_level(user, 100)
+
+        if self.config.get("allow_at_room", False):
+            changes.set_notification_level('room', 0)
+
+        return changes
+
     async def archive_matrix_room(self, matrix_room_id):
         # Make sure the room isn't already archived first
-        with self.memory[matrix_room_id]:
-            is_archived = await self.opsdroid.memory.get("is_archived")
+        is_archived = await self.memory.get("is_archived", room=matrix_room_id)
 
         if is_archived:
             _LOGGER.debug(f"The room {matrix_room_id} has already been archived. {is_archived}.")
             return
 
         # Change default speak power level so folks can't chat
-        power_levels = await self.matrix_api.get_power_levels(matrix_room_id)
-        power_levels['events_default'] = 50
-
-        await self.opsdroid.send(MatrixPowerLevels(power_levels,
-                                                   target=matrix_room_id,
-                                                   connector=self.matrix_connector))
+        changes = PowerLevelChanges()
+        changes.set_level('events_default', 50)
+        await self.update_power_levels(matrix_room_id, changes)
 
         # Edit name of room so we know it's archived
         old_name = await self.matrix_api.get_room_name(matrix_room_id)
@@ -227,28 +478,48 @@ class MatrixMixin:
                                           name=new_name,
                                           connector=self.matrix_connector))
 
-        with self.memory[matrix_room_id]:
-            is_archived = await self.opsdroid.memory.put("is_archived", True)
+        await self.memory.put("is_archived", True, room=matrix_room_id)
+
+        await self._archived_rooms.add(matrix_room_id)
 
     async def unarchive_matrix_room(self, matrix_room_id):
         # Make sure the room is archived first
-        with self.memory[matrix_room_id]:
-            is_archived = await self.opsdroid.memory.get("is_archived")
+        is_archived = await self.memory.get("is_archived", room=matrix_room_id)
 
         if not is_archived:
             _LOGGER.debug(f"The room {matrix_room_id} is not archived can't unarchive it.")
             return
 
         # Change default speak power level so folks can chat
-        power_levels = await self.matrix_api.get_power_levels(matrix_room_id)
-        power_levels['events_default'] = 0
+        changes = PowerLevelChanges()
+        changes.set_level('events_default', 0)
+        await self.update_power_levels(matrix_room_id, changes)
+
+        await self.memory.put("is_archived", False, room=matrix_room_id)
+
+        await self._archived_rooms.discard(matrix_room_id)
+
+    async def backfill_archived_rooms(self, matrix_room_ids):
+        """
+        Add any of the rooms which are archived to the index of archived rooms.
+
+        Rooms archived before the index existed are only marked as archived in
+        their own memory, so each room is checked there the first time it is seen.
+        """
+        await self._archived_rooms.load()
+        await self._archive_checked_rooms.load()
+        unchecked = [matrix_room_id for matrix_room_id in matrix_room_ids
+                     if matrix_room_id not in self._archive_checked_rooms]
+        if not unchecked:
+            return
 
-        await self.opsdroid.send(MatrixPowerLevels(power_levels,
-                                                   target=matrix_room_id,
-                                                   connector=self.matrix_connector))
+        archived = []
+        for matrix_room_id in unchecked:
+            if await self.memory.get("is_archived", room=matrix_room_id):
+                archived.append(matrix_room_id)
 
-        with self.memory[matrix_room_id]:
-            is_archived = await self.opsdroid.memory.put("is_archived", False)
+        await self._archived_rooms.update(archived)
+        await self._archive_checked_rooms.update(unchecked)
 
     async def _get_joined_members(self, matrix_room_id):
         """
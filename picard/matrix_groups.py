@@ -4,6 +4,7 @@ This file handles all the community interaction stuff with matrix.
 It is implemented here and not in the connector because it isn't part of the
 matrix spec yet and liable to change.
 """
+import asyncio
 import logging
 from functools import wraps
 from urllib.parse import quote
@@ -13,7 +14,6 @@ from matrix_client.errors import MatrixRequestError
 
 from opsdroid.events import JoinGroup
 from opsdroid.matchers import match_crontab, match_regex
-from opsdroid.connector.matrix.events import MatrixStateEvent
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -26,9 +26,7 @@ def if_community_configured(f):
     @wraps(f)
     async def wrapper(self, *args, **kwargs):
         if self.config.get("community_id", "").startswith("+"):
-            community_id = self.config['community_id']
-            if not await self._community_exists(community_id):
-                await self.create_community(community_id)
+            await self._ensure_community_exists(self.config['community_id'])
             return await f(self, *args, **kwargs)
         else:
             _LOGGER.info("No community is configured, skipping community actions.")
@@ -71,18 +69,26 @@ class MatrixCommunityMixin:
             "PUT",
             f"/groups/{quote(community_id)}/admin/users/invite/{quote(matrix_user_id)}")
 
-    async def _get_community_users(self, community_id):
+    async def _iter_community_users(self, community_id):
+        # The groups API does not paginate, so this is always one chunk.
         response = await self.matrix_api._send(
             "GET",
             f"/groups/{quote(community_id)}/users")
-        return [r['user_id'] for r in response['chunk']]
+        for r in response['chunk']:
+            yield r['user_id']
 
-    async def _get_community_rooms(self, community_id):
+    async def _iter_community_rooms(self, community_id):
         response = await self.matrix_api._send(
             "GET",
             f"/groups/{quote(community_id)}/rooms")
-        rooms = [r['room_id'] for r in response['chunk']]
-        return rooms
+        for r in response['chunk']:
+            yield r['room_id']
+
+    async def _get_community_users(self, community_id):
+        return [user async for user in self._iter_community_users(community_id)]
+
+    async def _get_community_rooms(self, community_id):
+        return [room async for room in self._iter_community_rooms(community_id)]
 
     async def _get_community_profile(self, community_id):
         return await self.matrix_api._send("GET", f"/groups/{quote(community_id)}/profile")
@@ -95,23 +101,30 @@ class MatrixCommunityMixin:
 
     # Picard methods
 
-    async def _community_exists(self, community_id):
-        """
-        Looks up a community to see if it exists. Also caches all the lookups.
+    async def _ensure_community_exists(self, community_id):
         """
-        if not hasattr(self, "_community_cache"):
-            self._community_cache = []
+        Make sure a community exists, creating it if it does not.
 
-        if community_id in self._community_cache:
+        This is cached, and concurrent calls for one community share both the
+        lookup and the creation.
+        """
+        async def ensure_exists(community_id):
+            try:
+                await self._get_community_profile(community_id)
+                return True
+            except MatrixRequestError as e:
+                if e.code != 404:
+                    _LOGGER.exception(f"Failed to look up community {community_id}.")
+
+            try:
+                await self.create_community(community_id)
+            except MatrixRequestError as e:
+                # Someone else created it since we looked.
+                if "already exists" not in str(e.content):
+                    raise
             return True
 
-        try:
-            await self._get_community_profile(community_id)
-        except MatrixRequestError:
-            return False
-
-        self._community_cache.append(community_id)
-        return True
+        return await self._community_cache.get(community_id, ensure_exists)
 
     @if_community_configured
     async def get_all_community_rooms(self):
@@ -139,38 +152,69 @@ class MatrixCommunityMixin:
         members = await self._get_community_members(self.config['community_id'])
         return await self.invite_to_matrix_room(matrix_room_id, members)
 
-    async def set_related_groups(self, matrix_room_id):
+    def _related_groups(self):
         """
-        Set the m.room.related_groups state from a room
+        The valid group identifiers from the related_groups config.
         """
-        groups = self.config.get("related_groups", [])
-        if not groups:
-            return
-
-        for group in groups:
+        groups = []
+        for group in self.config.get("related_groups", []):
             if not group.startswith("+"):
                 _LOGGER.error(f"{group} is not a valid group identifier.")
-                groups.remove(group)
-
-        content = {'groups': groups}
+                continue
+            groups.append(group)
 
-        return await self.opsdroid.send(MatrixStateEvent("m.room.related_groups",
-                                                         content=content,
-                                                         target=matrix_room_id,
-                                                         connector=self.matrix_connector))
+        return groups
 
     @match_crontab('* * * * *')
     async def _watch_for_new_users(self, message):
+        """
+        Make sure the community watcher is running.
+
+        The watcher polls on its own adaptive schedule, this only restarts it
+        if it is not running.
+        """
         if "community_id" not in self.config:
             return
 
-        known_users = set(await self.opsdroid.memory.get("known_community_users") or [])
-        community_users = await self.get_all_community_users()
+        if self._community_watcher is None or self._community_watcher.done():
+            self._community_watcher = asyncio.ensure_future(self._community_watcher_loop())
+
+    async def _community_watcher_loop(self):
+        """
+        Poll the community for new users, more often while people are joining.
+
+        The interval is reset to the minimum whenever the membership changes
+        and doubled, up to the maximum, whenever it does not.
+        """
+        min_interval = self.config.get("community_poll_min_interval", 15)
+        max_interval = self.config.get("community_poll_max_interval", 300)
+        interval = min_interval
+
+        while True:
+            try:
+                changes = await self._poll_community_users()
+            except Exception:
+                _LOGGER.exception("Failed to check the community for new users.")
+                changes = 0
+
+            interval = min_interval if changes else min(interval * 2, max_interval)
+            await asyncio.sleep(interval)
+
+    async def _poll_community_users(self):
+        """
+        Compare the community members to the known users and react to any new ones.
+
+        Returns the number of users who joined or left.
+        """
+        known_users = self._known_community_users
+        await known_users.load()
+
+        community_users = set(await self.get_all_community_users() or [])
         # Skip ourself.
-        community_users.remove(self.matrix_connector.mxid)
-        community_users = set(community_users)
+        community_users.discard(self.matrix_connector.mxid)
 
-        new_users = community_users.difference(known_users)
+        new_users = {user for user in community_users if user not in known_users}
+        left_users = {user for user in known_users if user not in community_users}
         _LOGGER.debug(f"Got the following new community users {new_users}")
 
         for user in new_users:
@@ -179,4 +223,7 @@ class MatrixCommunityMixin:
                                                 target=self.config['community_id'],
                                                 connector=self.matrix_connector))
 
-        await self.opsdroid.memory.put("known_community_users", list(community_users))
+        await known_users.update(new_users)
+        await known_users.difference_update(left_users)
+
+        return len(new_users) + len(left_users)
@@ -0,0 +1,173 @@
+"""
+Counting and timing the requests picard makes and the work it does.
+
+Timings are kept in histograms with fixed buckets, so recording one is cheap
+and the memory used does not grow with the number of calls.
+"""
+import bisect
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+from urllib.parse import unquote
+
+_LOGGER = logging.getLogger(__name__)
+
+__all__ = ['Histogram', 'Metrics', 'timed', 'matrix_path_template']
+
+# Upper bounds of the histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def matrix_path_template(path):
+    """
+    Replace the ids in a matrix API path with ``{id}``, so all the requests
+    to one endpoint are counted together.
+    """
+    segments = []
+    for segment in path.split('?', 1)[0].split('/'):
+        unquoted = unquote(segment)
+        if unquoted[:1] in ('!', '@', '#', '+', '$') or ':' in unquoted or unquoted.isdigit():
+            segment = '{id}'
+        segments.append(segment)
+
+    return '/'.join(segments)
+
+
+class Histogram:
+    """
+    The number, total and distribution of a set of durations.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimate a quantile by interpolating within the bucket it falls in.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0
+                if i == len(self.buckets):
+                    # Above the largest bucket, all we know is the lower bound.
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+
+        return self.buckets[-1]
+
+
+class Metrics:
+    """
+    A collection of histograms, one per metric name and set of labels.
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Time the block, recording whether it raised in the ``status`` label.
+        """
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            yield
+            status = 'ok'
+        finally:
+            self.observe(name, time.perf_counter() - start, status=status, **labels)
+
+    def install_connector(self, connector):
+        """
+        Time every event sent with an opsdroid connector, by event type.
+        """
+        if getattr(connector, '_picard_timed', False):
+            return connector
+
+        send = connector.send
+
+        @wraps(send)
+        async def timed_send(event):
+            with self.time("picard_event_send_seconds",
+                           connector=connector.name,
+                           event=type(event).__name__):
+                return await send(event)
+
+        connector.send = timed_send
+        connector._picard_timed = True
+        return connector
+
+    def summary(self):
+        """
+        A line per histogram with the call count and p50/p99 latencies.
+        """
+        lines = []
+        for (name, labels), histogram in sorted(self._histograms.items()):
+            label_text = ", ".join(f"{value}" for _, value in labels)
+            lines.append(f"{name} [{label_text}]: {histogram.count} calls, "
+                         f"p50 {histogram.quantile(0.5):.3f}s, "
+                         f"p99 {histogram.quantile(0.99):.3f}s")
+        return lines
+
+    def prometheus(self):
+        """
+        All the histograms in the Prometheus text exposition format.
+        """
+        lines = []
+        names = sorted({name for name, _ in self._histograms})
+        for name in names:
+            lines.append(f"# TYPE {name} histogram")
+            for (hist_name, labels), histogram in sorted(self._histograms.items()):
+                if hist_name != name:
+                    continue
+                label_pairs = [f'{key}="{_escape(value)}"' for key, value in labels]
+
+                cumulative = 0
+                bounds = [str(bound) for bound in histogram.buckets] + ["+Inf"]
+                for bound, count in zip(bounds, histogram.counts):
+                    cumulative += count
+                    bucket_labels = ",".join(label_pairs + [f'le="{bound}"'])
+                    lines.append(f"{name}_bucket{{{bucket_labels}}} {cumulative}")
+
+                label_text = ",".join(label_pairs)
+                lines.append(f"{name}_sum{{{label_text}}} {histogram.sum}")
+                lines.append(f"{name}_count{{{label_text}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def timed(f):
+    """
+    Record how long the decorated method takes, as a pipeline named after it.
+    """
+    @wraps(f)
+    async def wrapper(self, *args, **kwargs):
+        with self._metrics.time("picard_pipeline_seconds", pipeline=f.__name__):
+            return await f(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,108 @@
+"""
+A client for the provisioning API of matrix-appservice-slack.
+"""
+import asyncio
+import logging
+
+import aiohttp
+
+_LOGGER = logging.getLogger(__name__)
+
+__all__ = ['BridgeProvisioningClient', 'BridgeProvisioningError']
+
+
+class BridgeProvisioningError(Exception):
+    """
+    The bridge refused a provisioning request, or did not do what was asked.
+    """
+
+
+class BridgeProvisioningClient:
+    """
+    Link and unlink rooms with the bridge's provisioning API at ``url``.
+
+    The API has no batch endpoint, so links requested at about the same time
+    are collected into batches of up to ``batch_size``. All the links in a
+    batch are sent concurrently over one pool of connections, and each is
+    then confirmed by asking the bridge what the room is linked to.
+    """
+    def __init__(self, url, user_id, batch_size=20, timeout=30):
+        self.url = url.rstrip('/')
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._session = None
+        self._pending = []
+        self._flushing = False
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+
+    async def request(self, verb, **params):
+        """
+        Call a provisioning API command, returning the response body.
+        """
+        params.setdefault('user_id', self.user_id)
+        async with self.session.post(f"{self.url}/_matrix/provision/{verb}", json=params) as resp:
+            try:
+                body = await resp.json(content_type=None)
+            except ValueError:
+                body = {}
+            if resp.status != 200:
+                raise BridgeProvisioningError(
+                    f"{verb} failed with {resp.status}: {body.get('error', body)}")
+            return body
+
+    async def link(self, matrix_room_id, slack_channel_id, slack_team_id):
+        """
+        Link a matrix room to a slack channel, returning once the bridge has confirmed it.
+
+        The bridge only makes the link if ``user_id`` has authorised it with
+        the slack team ``slack_team_id``.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending.append((matrix_room_id, slack_channel_id, slack_team_id, future))
+        if not self._flushing:
+            asyncio.ensure_future(self._flush())
+        return await future
+
+    async def _flush(self):
+        self._flushing = True
+        try:
+            # Let the other links requested at the same time join the batch.
+            await asyncio.sleep(0)
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+                _LOGGER.debug(f"Linking a batch of {len(batch)} rooms with the provisioning API.")
+                await asyncio.gather(*[self._link_and_confirm(*link) for link in batch])
+        finally:
+            self._flushing = False
+
+    async def _link_and_confirm(self, matrix_room_id, slack_channel_id, slack_team_id, future):
+        try:
+            await self.request("link", matrix_room_id=matrix_room_id,
+                               channel_id=slack_channel_id, team_id=slack_team_id)
+            link = await self.request("getlink", matrix_room_id=matrix_room_id)
+            if link.get('slack_channel_id') != slack_channel_id:
+                raise BridgeProvisioningError(
+                    f"{matrix_room_id} is linked to {link.get('slack_channel_id')} "
+                    f"not {slack_channel_id}.")
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(link)
+
+    async def unlink(self, matrix_room_id):
+        return await self.request("unlink", matrix_room_id=matrix_room_id)
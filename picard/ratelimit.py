@@ -0,0 +1,317 @@
+"""
+Helpers for dealing with the rate limits of the slack and matrix APIs.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import slack
+from matrix_client.errors import MatrixRequestError
+
+from .metrics import matrix_path_template
+
+_LOGGER = logging.getLogger(__name__)
+
+__all__ = ['retry_after', 'request_priority', 'interactive',
+           'RequestScheduler', 'TokenBucket', 'INTERACTIVE', 'BACKGROUND']
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+_request_priority = contextvars.ContextVar("picard_request_priority", default=BACKGROUND)
+# The bucket of the scheduled matrix request being sent, if any.
+_matrix_bucket = contextvars.ContextVar("picard_matrix_bucket", default=None)
+
+
+@contextmanager
+def request_priority(priority):
+    """
+    Set the scheduling priority of the requests made inside this block.
+
+    The priority is inherited by any tasks started inside the block.
+    """
+    token = _request_priority.set(priority)
+    try:
+        yield
+    finally:
+        _request_priority.reset(token)
+
+
+def interactive(f):
+    """
+    Give the requests made by the decorated command priority over background work.
+    """
+    @wraps(f)
+    async def wrapper(*args, **kwargs):
+        with request_priority(INTERACTIVE):
+            return await f(*args, **kwargs)
+
+    return wrapper
+
+
+def retry_after(error):
+    """
+    The number of seconds the server asked us to wait before retrying, or
+    `None` if the error was not caused by a rate limit.
+    """
+    if isinstance(error, slack.errors.SlackApiError):
+        response = error.response
+        if response.status_code == 429:
+            return float(response.headers.get('Retry-After', 1))
+
+    if isinstance(error, MatrixRequestError) and error.code == 429:
+        try:
+            content = json.loads(error.content)
+        except (TypeError, ValueError):
+            content = {}
+        return content.get('retry_after_ms', 1000) / 1000
+
+    return None
+
+
+class TokenBucket:
+    """
+    Allow requests at ``rate`` per second on average, in bursts of up to ``capacity``.
+
+    Requests waiting for a token are served in priority order. When the
+    server rate limits us the bucket stops handing out tokens for as long as
+    it asked, and halves its rate, which then recovers as requests succeed.
+    """
+    def __init__(self, rate, capacity):
+        self.base_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._waiters = []
+        self._counter = itertools.count()
+        self._wakeup = None
+
+    @property
+    def queue_depth(self):
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+    def _take(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return False
+
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    async def acquire(self, priority=BACKGROUND):
+        if not self._waiters and self._take():
+            return
+
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        self._schedule()
+        await future
+
+    def _dispatch(self):
+        self._wakeup = None
+        while self._waiters:
+            future = self._waiters[0][2]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if not self._take():
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+        self._schedule()
+
+    def _schedule(self):
+        if self._wakeup is not None or not self._waiters:
+            return
+
+        now = time.monotonic()
+        delay = max(self._paused_until - now, (1 - self._tokens) / self.rate, 0)
+        self._wakeup = asyncio.get_event_loop().call_later(delay, self._dispatch)
+
+    def rate_limited(self, retry_after):
+        """
+        The server rate limited a request, back off.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        self._tokens = 0
+        self.rate = max(self.base_rate / 10, self.rate / 2)
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        self._schedule()
+
+    def succeeded(self):
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate / 20)
+
+
+class RequestScheduler:
+    """
+    Flow control for all the requests picard makes to matrix and slack.
+
+    Each API family (or slack rate limit tier) has its own TokenBucket. The
+    scheduler is installed by wrapping the method every request of a matrix
+    API object or slack WebClient goes through, so requests made by opsdroid
+    on picard's behalf are scheduled too.
+
+    ``rates`` overrides the default number of requests per minute of a bucket.
+    If ``metrics`` is given, every scheduled request is counted and timed in it.
+    """
+    # requests per minute, burst size
+    default_rates = {
+        'matrix': (600, 20),
+        'matrix.groups': (120, 5),
+        'slack.tier1': (1, 1),
+        'slack.tier2': (20, 3),
+        'slack.tier3': (50, 5),
+        'slack.tier4': (100, 10),
+        'slack.chat': (60, 5),
+    }
+
+    slack_method_buckets = {
+        'auth.test': 'slack.tier4',
+        'channels.create': 'slack.tier2',
+        'channels.info': 'slack.tier3',
+        'channels.invite': 'slack.tier3',
+        'channels.join': 'slack.tier3',
+        'channels.list': 'slack.tier2',
+        'channels.rename': 'slack.tier2',
+        'channels.setTopic': 'slack.tier2',
+        'chat.postMessage': 'slack.chat',
+        'im.open': 'slack.tier3',
+        'users.info': 'slack.tier4',
+        'users.list': 'slack.tier2',
+    }
+
+    # Long polling requests which must not wait behind anything else.
+    unscheduled_matrix_paths = ('/sync',)
+
+    def __init__(self, rates=None, retries=3, metrics=None):
+        self.rates = dict(self.default_rates)
+        for name, per_minute in (rates or {}).items():
+            burst = self.rates.get(name, (per_minute, 1))[1]
+            self.rates[name] = (per_minute, burst)
+        self.retries = retries
+        self.metrics = metrics
+        self._buckets = {}
+
+    def bucket(self, name):
+        if name not in self._buckets:
+            per_minute, burst = self.rates.get(name, self.rates['slack.tier3'])
+            self._buckets[name] = TokenBucket(per_minute / 60, burst)
+        return self._buckets[name]
+
+    @property
+    def queue_depths(self):
+        return {name: bucket.queue_depth for name, bucket in self._buckets.items()}
+
+    async def run(self, bucket_name, func, *args, **kwargs):
+        """
+        Await ``func(*args, **kwargs)`` when the bucket allows it, retrying
+        if the server rate limits it.
+        """
+        bucket = self.bucket(bucket_name)
+        priority = _request_priority.get()
+        for attempt in range(self.retries + 1):
+            await bucket.acquire(priority)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as error:
+                delay = retry_after(error)
+                if delay is None:
+                    raise
+                bucket.rate_limited(delay)
+                if attempt == self.retries:
+                    raise
+                _LOGGER.info(f"Rate limited on {bucket_name}, retrying in {delay} seconds.")
+                continue
+
+            bucket.succeeded()
+            return result
+
+    def install_matrix(self, api):
+        """
+        Schedule all requests made with a matrix_client API object.
+
+        Rate limited requests are retried by the scheduler rather than by the
+        library's own loop, so that they slow down the bucket.
+        """
+        if getattr(api, '_picard_scheduled', False):
+            return api
+
+        send = api._send
+        get_waittime = api._get_waittime
+
+        @wraps(get_waittime)
+        def scheduled_get_waittime(responsejson):
+            waittime = get_waittime(responsejson)
+            if _matrix_bucket.get() is None:
+                return waittime
+            # The library would sleep and send again without asking the
+            # bucket, so hand the 429 back to the scheduler instead.
+            raise MatrixRequestError(code=429, content=json.dumps({
+                'errcode': "M_LIMIT_EXCEEDED", 'retry_after_ms': int(waittime * 1000)}))
+
+        @wraps(send)
+        async def scheduled_send(method, path, *args, **kwargs):
+            if path.startswith(self.unscheduled_matrix_paths):
+                return await send(method, path, *args, **kwargs)
+            is_groups = path.lstrip('/').startswith(('groups/', 'create_group'))
+            bucket = 'matrix.groups' if is_groups else 'matrix'
+            token = _matrix_bucket.set(bucket)
+            try:
+                if self.metrics is None:
+                    return await self.run(bucket, send, method, path, *args, **kwargs)
+
+                async def timed_send():
+                    with self.metrics.time("picard_matrix_request_seconds",
+                                           method=method, path=matrix_path_template(path)):
+                        return await send(method, path, *args, **kwargs)
+
+                return await self.run(bucket, timed_send)
+            finally:
+                _matrix_bucket.reset(token)
+
+        api._send = scheduled_send
+        api._get_waittime = scheduled_get_waittime
+        api._picard_scheduled = True
+        return api
+
+    def install_slack(self, client):
+        """
+        Schedule all requests made with a slack WebClient.
+        """
+        if getattr(client, '_picard_scheduled', False):
+            return client
+
+        send = client._send
+
+        @wraps(send)
+        async def scheduled_send(http_verb, api_url, req_args):
+            api_method = api_url.rsplit('/', 1)[-1]
+            bucket = self.slack_method_buckets.get(api_method, 'slack.tier3')
+            if self.metrics is None:
+                return await self.run(bucket, send, http_verb, api_url, req_args)
+
+            async def timed_send():
+                with self.metrics.time("picard_slack_request_seconds", method=api_method):
+                    return await send(http_verb, api_url, req_args)
+
+            return await self.run(bucket, timed_send)
+
+        client._send = scheduled_send
+        client._picard_scheduled = True
+        return client
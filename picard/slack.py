@@ -1,7 +1,9 @@
+import asyncio
 import os
 import logging
 from contextlib import contextmanager
 
+import aiohttp
 import slack
 
 from opsdroid.events import NewRoom, RoomDescription
@@ -30,26 +32,97 @@ class SlackMixin:
 
     @property
     def slack_bot_client(self):
-        return self.slack_connector.slack
+        return self._request_scheduler.install_slack(self.slack_connector.slack)
 
     @property
     def slack_user_client(self):
         """
-        A Slack client context manager to do operations with the user token.
+        A long-lived Slack client to do operations with the user token.
+
+        All requests made with it share one pool of keep-alive connections.
+        """
+        if self._slack_user_client is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.config.get("slack_connection_pool_size", 10),
+                keepalive_timeout=self.config.get("slack_keepalive_timeout", 30),
+                ssl=self.slack_connector.ssl_context)
+
+            self._slack_user_client = self._request_scheduler.install_slack(slack.WebClient(
+                token=self.slack_user_token,
+                run_async=True,
+                ssl=self.slack_connector.ssl_context,
+                proxy=os.environ.get("HTTPS_PROXY"),
+                session=aiohttp.ClientSession(connector=connector),
+            ))
+            self._close_slack_user_client_on_disconnect()
+
+        return self._slack_user_client
+
+    async def close_slack_user_client(self):
+        """
+        Close the connections of the user token client.
+        """
+        if self._slack_user_client is None:
+            return
+        session = self._slack_user_client.session
+        self._slack_user_client = None
+        await session.close()
+
+    def _close_slack_user_client_on_disconnect(self):
         """
-        return slack.WebClient(
-            token=self.slack_user_token,
-            run_async=True,
-            ssl=self.slack_connector.ssl_context,
-            proxy=os.environ.get("HTTPS_PROXY"),
-        )
+        Close the user token client when opsdroid disconnects the slack connector.
+
+        opsdroid does not tell skills when it is shutting down, so this is the
+        closest thing we have to a teardown hook.
+        """
+        connector = self.slack_connector
+        disconnect = connector.disconnect
+
+        async def disconnect_and_close(*args, **kwargs):
+            await self.close_slack_user_client()
+            return await disconnect(*args, **kwargs)
+
+        connector.disconnect = disconnect_and_close
 
     async def _id_for_slack_user_token(self):
         """
         The user id of the slack_user_token.
+
+        This never changes, so it is only looked up once.
+        """
+        if self._slack_user_token_id is None:
+            resp = await self.slack_user_client.auth_test()
+            self._slack_team_id = resp.data['team_id']
+            self._slack_user_token_id = resp.data['user_id']
+        return self._slack_user_token_id
+
+    async def get_slack_team_id(self):
+        """
+        The id of the slack team picard is bridging, looked up with the user id of the user token.
         """
-        resp = await self.slack_user_client.auth_test()
-        return resp.data['user_id']
+        if self._slack_team_id is None:
+            await self._id_for_slack_user_token()
+        return self._slack_team_id
+
+    async def _id_for_slack_bot_token(self):
+        """
+        The user id of the slack bot token.
+        """
+        if self._slack_bot_token_id is None:
+            resp = await self.slack_bot_client.auth_test()
+            self._slack_bot_token_id = resp.data['user_id']
+        return self._slack_bot_token_id
+
+    async def _resolve_slack_token_identities(self):
+        """
+        Look up who both slack tokens belong to, so events picard caused can be ignored.
+        """
+        try:
+            await asyncio.gather(self._id_for_slack_user_token(),
+                                 self._id_for_slack_bot_token())
+        except Exception:
+            # They will be looked up again when they are first needed.
+            _LOGGER.exception("Failed to look up the identities of the slack tokens.")
 
     async def set_slack_channel_description(self, slack_channel_id, description):
         """
@@ -58,6 +131,7 @@ class SlackMixin:
         try:
             resp = await self.slack_user_client.channels_setTopic(channel=slack_channel_id,
                                                                   topic=description)
+            self._slack_channels.set_topic(slack_channel_id, resp.data['topic'])
             return resp.data['topic']
         except slack.errors.SlackApiError as err:
             _LOGGER.exception(err)
@@ -72,6 +146,7 @@ class SlackMixin:
             if err.response.data['error'] == "name_taken":
                 return await self.get_slack_channel_id_from_name(channel_name)
             raise err
+        self._slack_channels.update(resp.data["channel"])
         return resp.data["channel"]["id"]
 
     async def invite_user_to_slack_channel(self, slack_channel_id, user_id):
@@ -86,49 +161,160 @@ class SlackMixin:
             if err.response.data['error'] != 'already_in_channel':
                 _LOGGER.exception(err)
 
+    async def _get_slack_user_directory(self, reload=False):
+        """
+        The user directory, loaded from slack the first time it is needed.
+        """
+        if reload or not self._slack_users.is_loaded:
+            async with self._slack_users_lock:
+                if reload or not self._slack_users.is_loaded:
+                    self._slack_users.load([user async for user in self.iter_slack_users()])
+
+        return self._slack_users
+
+    async def _iter_slack_pages(self, method, key, page_size=None):
+        """
+        Yield every item of a paginated slack listing, following the cursors.
+
+        The next page is requested before the items of the current page are
+        yielded, so it downloads while the caller works on them.
+        """
+        page_size = page_size or self.config.get("slack_page_size", 200)
+        next_page = asyncio.ensure_future(method(limit=page_size))
+        while next_page:
+            response = await next_page
+            cursor = response.data.get('response_metadata', {}).get('next_cursor')
+            next_page = cursor and asyncio.ensure_future(method(limit=page_size, cursor=cursor))
+
+            try:
+                for item in response.data[key]:
+                    yield item
+            except GeneratorExit:
+                if next_page:
+                    next_page.cancel()
+                raise
+
+    def iter_slack_users(self, page_size=None):
+        """
+        Yield the info dict of every user in the team.
+        """
+        return self._iter_slack_pages(self.slack_bot_client.users_list, 'members', page_size)
+
+    def iter_slack_channels(self, page_size=None):
+        """
+        Yield the info dict of every channel.
+        """
+        return self._iter_slack_pages(self.slack_bot_client.channels_list, 'channels', page_size)
+
+    def update_slack_user(self, user):
+        """
+        Update the user directory from the user dict in a slack event.
+        """
+        if self._slack_users.is_loaded:
+            self._slack_users.update(user)
+
+    async def _on_slack_user_change(self, **payload):
+        """
+        RTM callback for the user_change event.
+        """
+        self.update_slack_user(payload['data']['user'])
+
+    def _register_slack_rtm_callbacks(self):
+        """
+        Listen to the slack events opsdroid does not turn into opsdroid events.
+        """
+        slack.RTMClient.run_on(event="user_change")(self._on_slack_user_change)
+
     async def get_slack_user_id(self, user_name):
         """
-        Look up a slack user id based on their name.
+        Look up a slack user id based on their name or display name.
         """
-        members = await self.slack_bot_client.users_list()
-        name_id_map = {m['name']: m['id'] for m in members.data['members']}
-        return name_id_map[user_name]
+        directory = await self._get_slack_user_directory()
+        slack_user_id = directory.id_for_name(user_name)
+
+        # The user might have joined since the directory was loaded.
+        if slack_user_id is None:
+            directory = await self._get_slack_user_directory(reload=True)
+            slack_user_id = directory.id_for_name(user_name)
+
+        if slack_user_id is None:
+            raise KeyError(user_name)
+
+        return slack_user_id
 
     async def get_slack_channel_list(self):
-        response = await self.slack_bot_client.channels_list()
-        return response.data['channels']
+        return [channel async for channel in self.iter_slack_channels()]
 
     async def get_slack_channel_mapping(self):
         """
         Map slack channel ids to their channel info dict
+
+        This always gets a fresh list from slack, and reloads the channel directory with it.
         """
         channels = await self.get_slack_channel_list()
+        self._slack_channels.load(channels)
         return {c['id']: c for c in channels}
 
+    async def _get_slack_channel_directory(self):
+        """
+        The channel directory, (re)loaded from slack if it is stale.
+        """
+        if self._slack_channels.is_stale:
+            async with self._slack_channels_lock:
+                if self._slack_channels.is_stale:
+                    self._slack_channels.load(await self.get_slack_channel_list())
+
+        return self._slack_channels
+
+    async def get_slack_channel_info(self, slack_channel_id):
+        """
+        Get the info dict for a channel, from the directory if possible.
+        """
+        directory = await self._get_slack_channel_directory()
+        channel = directory.get(slack_channel_id)
+        if channel is None:
+            response = await self.slack_bot_client.channels_info(channel=slack_channel_id)
+            channel = response.data['channel']
+            directory.update(channel)
+
+        return channel
+
     async def get_slack_channel_topic(self, slack_channel_id):
         """
         Get the topic for a channel.
         """
-        response = await self.slack_bot_client.channels_info(channel=slack_channel_id)
-        return response.data['channel'].get('topic', {}).get('value', '')
+        channel = await self.get_slack_channel_info(slack_channel_id)
+        return channel.get('topic', {}).get('value', '')
 
     async def get_slack_channel_name(self, slack_channel_id):
         """
         Get the name for a channel.
         """
-        response = await self.slack_bot_client.channels_info(channel=slack_channel_id)
-        return response.data['channel']['name']
+        channel = await self.get_slack_channel_info(slack_channel_id)
+        return channel['name']
 
     async def set_slack_channel_name(self, slack_channel_id, name):
         """
-        Get the name for a channel.
+        Set the name for a channel.
         """
-        return await self.slack_user_client.channels.rename(channel=slack_channel_id, name=name)
+        resp = await self.slack_user_client.channels_rename(channel=slack_channel_id, name=name)
+        self._slack_channels.rename(slack_channel_id, name)
+        return resp
 
     async def get_slack_channel_id_from_name(self, slack_channel_name):
-        channel_map = await self.get_slack_channel_mapping()
-        name_to_id = {c['name']: k for k, c in channel_map.items()}
-        return name_to_id[slack_channel_name.lower()]
+        slack_channel_name = slack_channel_name.lower()
+        directory = await self._get_slack_channel_directory()
+        slack_channel_id = directory.id_for_name(slack_channel_name)
+
+        # The channel might have been created since the directory was loaded.
+        if slack_channel_id is None:
+            await self.get_slack_channel_mapping()
+            slack_channel_id = directory.id_for_name(slack_channel_name)
+
+        if slack_channel_id is None:
+            raise KeyError(slack_channel_name)
+
+        return slack_channel_id
 
     def clean_slack_message(self, message):
         message = message.replace("<", "")
@@ -139,8 +325,8 @@ class SlackMixin:
         return message
 
     async def get_all_slack_users(self):
-        response = await self.slack_bot_client.users_list()
-        return [m['id'] for m in response.data['members']]
+        directory = await self._get_slack_user_directory()
+        return [m['id'] for m in directory]
 
     async def get_slack_direct_message_channel(self, slack_user_id):
         response = await self.slack_bot_client.im_open(user=slack_user_id)
@@ -0,0 +1,145 @@
+"""
+In-memory directories of slack workspace information.
+
+These hold the data picard looks up on most slack events, so that the lookups
+do not need a slack API call each time. They only store data, the SlackMixin
+is responsible for loading them and keeping them up to date.
+"""
+import time
+
+__all__ = ['SlackChannelDirectory', 'SlackUserDirectory']
+
+
+class SlackChannelDirectory:
+    """
+    Slack channel info dicts, indexed by channel id and by channel name.
+
+    The whole directory is considered stale ``ttl`` seconds after it was last
+    loaded, as a safety net for any changes picard did not hear about.
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._channels = {}
+        self._ids_by_name = {}
+        self._loaded_at = None
+
+    @property
+    def is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+
+    def load(self, channels):
+        """
+        Replace the contents of the directory with the given channels.
+        """
+        self._channels = {}
+        self._ids_by_name = {}
+        for channel in channels:
+            self.update(channel)
+        self._loaded_at = time.monotonic()
+
+    def mark_loaded(self, slack_channel_ids):
+        """
+        Mark the directory as freshly loaded, once every channel has been
+        added with ``update``, dropping channels which are not in
+        ``slack_channel_ids`` any more.
+        """
+        for slack_channel_id in set(self._channels) - set(slack_channel_ids):
+            self.discard(slack_channel_id)
+        self._loaded_at = time.monotonic()
+
+    def update(self, channel):
+        """
+        Add or replace the info for one channel.
+        """
+        self.discard(channel['id'])
+        self._channels[channel['id']] = channel
+        self._ids_by_name[channel['name']] = channel['id']
+
+    def discard(self, slack_channel_id):
+        """
+        Remove a channel, so that it will be looked up again next time.
+        """
+        channel = self._channels.pop(slack_channel_id, None)
+        if channel and self._ids_by_name.get(channel['name']) == slack_channel_id:
+            del self._ids_by_name[channel['name']]
+
+    def rename(self, slack_channel_id, name):
+        channel = self._channels.get(slack_channel_id)
+        if channel:
+            self.update(dict(channel, name=name))
+
+    def set_topic(self, slack_channel_id, topic):
+        channel = self._channels.get(slack_channel_id)
+        if channel:
+            topic_info = dict(channel.get('topic', {}), value=topic)
+            self._channels[slack_channel_id] = dict(channel, topic=topic_info)
+
+    def get(self, slack_channel_id):
+        return self._channels.get(slack_channel_id)
+
+    def id_for_name(self, slack_channel_name):
+        return self._ids_by_name.get(slack_channel_name)
+
+    def __len__(self):
+        return len(self._channels)
+
+    def __iter__(self):
+        return iter(self._channels.values())
+
+
+class SlackUserDirectory:
+    """
+    Slack user info dicts, indexed by user id, user name and display name.
+    """
+    def __init__(self):
+        self._users = {}
+        self._ids_by_name = {}
+        self._ids_by_display_name = {}
+        self.is_loaded = False
+
+    def load(self, users):
+        """
+        Replace the contents of the directory with the given users.
+        """
+        self._users = {}
+        self._ids_by_name = {}
+        self._ids_by_display_name = {}
+        for user in users:
+            self.update(user)
+        self.is_loaded = True
+
+    def update(self, user):
+        """
+        Add or replace the info for one user.
+        """
+        self.discard(user['id'])
+        self._users[user['id']] = user
+        self._ids_by_name[user['name']] = user['id']
+        display_name = user.get('profile', {}).get('display_name')
+        if display_name:
+            self._ids_by_display_name[display_name] = user['id']
+
+    def discard(self, slack_user_id):
+        user = self._users.pop(slack_user_id, None)
+        if not user:
+            return
+        if self._ids_by_name.get(user['name']) == slack_user_id:
+            del self._ids_by_name[user['name']]
+        display_name = user.get('profile', {}).get('display_name')
+        if self._ids_by_display_name.get(display_name) == slack_user_id:
+            del self._ids_by_display_name[display_name]
+
+    def get(self, slack_user_id):
+        return self._users.get(slack_user_id)
+
+    def id_for_name(self, user_name):
+        """
+        Look up a user id by user name, falling back to display name.
+        """
+        return self._ids_by_name.get(user_name, self._ids_by_display_name.get(user_name))
+
+    def __len__(self):
+        return len(self._users)
+
+    def __iter__(self):
+        return iter(self._users.values())
@@ -1,9 +1,97 @@
+import asyncio
+import logging
+
 import parse
 
+from opsdroid.connector.matrix.events import GenericMatrixRoomEvent
 from opsdroid.events import Message, UserInvite
+from opsdroid.matchers import match_event
 
+from .constraints import constrain_matrix_connector
+from .provisioning import BridgeProvisioningClient
 from .slack import SlackMixin
 
+_LOGGER = logging.getLogger(__name__)
+
+
+class BridgedRooms:
+    """
+    The two-way mapping between bridged matrix rooms and slack channels.
+
+    The mapping is persisted in opsdroid memory as a dict of matrix room id to
+    slack channel id, and loaded the first time it is used.
+    """
+    memory_key = "picard.bridged_rooms"
+
+    def __init__(self, memory):
+        self.memory = memory
+        self._slack_by_matrix = {}
+        self._matrix_by_slack = {}
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+        self._dirty = False
+        self._saving = False
+
+    async def _ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if not self._loaded:
+                links = await self.memory.get(self.memory_key) or {}
+                self._slack_by_matrix = dict(links)
+                self._matrix_by_slack = {v: k for k, v in links.items()}
+                self._loaded = True
+
+    async def _save(self):
+        """
+        Write the mapping to memory.
+
+        If a write is already in progress the change is picked up by that
+        writer, so concurrent links cause as few writes as possible.
+        """
+        self._dirty = True
+        if self._saving:
+            return
+
+        self._saving = True
+        try:
+            while self._dirty:
+                self._dirty = False
+                await self.memory.put(self.memory_key, dict(self._slack_by_matrix))
+        finally:
+            self._saving = False
+
+    async def link(self, matrix_room_id, slack_channel_id):
+        await self._ensure_loaded()
+        if self._slack_by_matrix.get(matrix_room_id) == slack_channel_id:
+            return
+
+        self._remove(matrix_room_id, self._matrix_by_slack.get(slack_channel_id))
+        self._slack_by_matrix[matrix_room_id] = slack_channel_id
+        self._matrix_by_slack[slack_channel_id] = matrix_room_id
+        await self._save()
+
+    async def unlink(self, matrix_room_id):
+        await self._ensure_loaded()
+        if matrix_room_id not in self._slack_by_matrix:
+            return
+
+        self._remove(matrix_room_id)
+        await self._save()
+
+    def _remove(self, *matrix_room_ids):
+        for matrix_room_id in matrix_room_ids:
+            slack_channel_id = self._slack_by_matrix.pop(matrix_room_id, None)
+            self._matrix_by_slack.pop(slack_channel_id, None)
+
+    async def slack_channel_id(self, matrix_room_id):
+        await self._ensure_loaded()
+        return self._slack_by_matrix.get(matrix_room_id)
+
+    async def matrix_room_id(self, slack_channel_id):
+        await self._ensure_loaded()
+        return self._matrix_by_slack.get(slack_channel_id)
+
 
 class SlackBridgeMixin(SlackMixin):
     """
@@ -15,21 +103,72 @@ class SlackBridgeMixin(SlackMixin):
                              " --slack_bot_token {token}"
                              " --slack_user_token {u_token}")
 
-    async def link_room(self, matrix_room_id, slack_channel_id):
+    link_methods = ("admin_room", "provisioning_api")
+
+    @property
+    def bridge_link_method(self):
+        """
+        How rooms are linked and unlinked, by commands in the bridge admin
+        room or with the bridge's provisioning API.
+        """
+        method = self.config.get("bridge_link_method", "admin_room")
+        if method not in self.link_methods:
+            raise ValueError(f"bridge_link_method must be one of {self.link_methods}, not {method}")
+        return method
+
+    @property
+    def bridge_provisioning_client(self):
+        """
+        The client for the bridge provisioning API, shared by all links so they can be batched.
+        """
+        if self._bridge_provisioning_client is None:
+            self._bridge_provisioning_client = BridgeProvisioningClient(
+                self.config["bridge_provisioning_url"],
+                self.matrix_connector.mxid,
+                batch_size=self.config.get("bridge_link_batch_size", 20))
+            self._close_bridge_provisioning_client_on_disconnect()
+
+        return self._bridge_provisioning_client
+
+    def _close_bridge_provisioning_client_on_disconnect(self):
+        connector = self.matrix_connector
+        disconnect = connector.disconnect
+
+        async def disconnect_and_close(*args, **kwargs):
+            if self._bridge_provisioning_client is not None:
+                client, self._bridge_provisioning_client = self._bridge_provisioning_client, None
+                await client.close()
+            return await disconnect(*args, **kwargs)
+
+        connector.disconnect = disconnect_and_close
+
+    async def link_room(self, matrix_room_id, slack_channel_id, appservice_bot_invited=False):
         """
         Link a Matrix room to a slack room.
+
+        ``appservice_bot_invited`` skips inviting the appservice bot, for rooms
+        which were created with it in the invite list.
         """
         # Invite the slack event bot to the slack channel
         await self.invite_slack_event_bot(slack_channel_id)
 
-        return await self._link_room_admin_message(matrix_room_id, slack_channel_id)
+        if self.bridge_link_method == "provisioning_api":
+            await self._link_room_provisioning_api(matrix_room_id, slack_channel_id,
+                                                   appservice_bot_invited)
+        else:
+            await self._link_room_admin_message(matrix_room_id, slack_channel_id,
+                                                appservice_bot_invited)
 
-    async def _link_room_admin_message(self, matrix_room_id, slack_channel_id):
+        await self._bridged_rooms.link(matrix_room_id, slack_channel_id)
+
+    async def _link_room_admin_message(self, matrix_room_id, slack_channel_id,
+                                       appservice_bot_invited=False):
         """
         Send a message to the slack bridge admin room to link this room to slack.
         """
         # Invite the appservice bot to the matrix room
-        await self.invite_appservice_bot(matrix_room_id)
+        if not appservice_bot_invited:
+            await self.invite_appservice_bot(matrix_room_id)
 
         # Send the link command
         token = self.slack_bot_token
@@ -37,29 +176,83 @@ class SlackBridgeMixin(SlackMixin):
 
         message = self.link_message_template.format(**locals())
 
-        await self.opsdroid.send(Message(message, target='bridge',
+        await self._bridge_commands.run(message)
+
+    async def _send_bridge_command(self, command):
+        await self.opsdroid.send(Message(command, target='bridge',
                                          connector=self.matrix_connector))
 
-    async def _link_room_provisioning_api(self, matrix_room_id, slack_channel_id):
+    @match_event(Message)
+    @match_event(GenericMatrixRoomEvent)
+    @constrain_matrix_connector
+    async def on_bridge_admin_reply(self, message):
+        """
+        Match the appservice bot's replies in the bridge admin room to the commands sent to it.
+
+        The bridge replies with notices, which opsdroid passes on as generic room events.
+        """
+        # There is no bridge room when rooms are linked with the provisioning API.
+        bridge_room_id = self.matrix_connector.room_ids.get('bridge')
+        if bridge_room_id is None or message.target != bridge_room_id:
+            return
+        if message.raw_event['sender'] != self.config["appservice_bot_mxid"]:
+            return
+        if isinstance(message, Message):
+            self._bridge_commands.reply(message.text)
+        elif message.event_type == "m.room.message":
+            self._bridge_commands.reply(message.content.get('body', ""))
+
+    async def create_bridged_matrix_room(self, name, topic, slack_channel_id,
+                                         include_autoinvite=True):
+        """
+        Provision a new matrix room in one request and bridge it to a slack channel.
+
+        Returns the room id and the canonical alias.
+        """
+        invite_users = await self.get_users_to_invite(include_autoinvite=include_autoinvite)
+        invite_users.append(self.config["appservice_bot_mxid"])
+
+        matrix_room_id, canonical_alias = await self.provision_new_matrix_room(
+            name, topic, self.config.get("make_public", False), invite_users)
+
+        await self.link_room(matrix_room_id, slack_channel_id, appservice_bot_invited=True)
+
+        await self.add_room_to_community(matrix_room_id)
+
+        return matrix_room_id, canonical_alias
+
+    async def _link_room_provisioning_api(self, matrix_room_id, slack_channel_id,
+                                          appservice_bot_invited=False):
         """
         Call the slack bridge provisioning api to link this room to slack.
+
+        Links made at the same time are sent in batches, and this returns once
+        the bridge has confirmed the room is linked.
         """
-        raise NotImplementedError("Wont get around to this one for a while.")
+        # The bridge can only link rooms its bot is in.
+        if not appservice_bot_invited:
+            await self.invite_appservice_bot(matrix_room_id)
+
+        slack_team_id = await self.get_slack_team_id()
+        await self.bridge_provisioning_client.link(matrix_room_id, slack_channel_id,
+                                                   slack_team_id)
+        _LOGGER.debug(f"Linked {matrix_room_id} to {slack_channel_id} with the provisioning API.")
 
     async def unlink_room(self, matrix_room_id, slack_channel_id=None):
         """
         Unlink and leave the bridge.
         """
-        await self._unlink_room_admin_message(matrix_room_id)
+        if self.bridge_link_method == "provisioning_api":
+            await self.bridge_provisioning_client.unlink(matrix_room_id)
+        else:
+            await self._unlink_room_admin_message(matrix_room_id)
+
+        await self._bridged_rooms.unlink(matrix_room_id)
 
     async def _unlink_room_admin_message(self, matrix_room_id):
-        await self.opsdroid.send(Message(f"leave {matrix_room_id}",
-                                         target='bridge',
-                                         connector=self.matrix_connector))
+        await self._bridge_commands.run(f"leave {matrix_room_id}")
 
-        await self.opsdroid.send(Message(f"unlink --room {matrix_room_id}",
-                                         target='bridge',
-                                         connector=self.matrix_connector))
+        await self._bridge_commands.run(f"unlink --room {matrix_room_id}")
 
     async def invite_appservice_bot(self, matrix_room_id):
         """
@@ -85,6 +278,11 @@ class SlackBridgeMixin(SlackMixin):
         return await self.invite_user_to_slack_channel(slack_channel_id, bot_user_id)
 
     async def matrix_room_id_from_slack_channel_id(self, slack_channel_id):
+        matrix_room_id = await self._bridged_rooms.matrix_room_id(slack_channel_id)
+        if matrix_room_id:
+            return matrix_room_id
+
+        # Fall back to the alias for rooms picard has not linked itself.
         slack_channel_name = await self.get_slack_channel_name(slack_channel_id)
         return await self.matrix_room_id_from_slack_channel_name(slack_channel_name)
 
@@ -99,8 +297,14 @@ class SlackBridgeMixin(SlackMixin):
 
     async def slack_channel_id_from_matrix_room_id(self, matrix_room_id):
         """
-        Get the slack channel id based on the canonical alias.
+        Get the slack channel id for a bridged room.
+
+        If picard did not link the room itself, work it out from the canonical alias.
         """
+        slack_channel_id = await self._bridged_rooms.slack_channel_id(matrix_room_id)
+        if slack_channel_id:
+            return slack_channel_id
+
         room_state = await self.matrix_api.get_room_state(matrix_room_id)
         room_state = list(filter(lambda x: x['type'] == "m.room.canonical_alias", room_state))
         if not room_state:
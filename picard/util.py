@@ -1,21 +1,385 @@
-from contextlib import contextmanager
+import asyncio
+import logging
+import time
+import zlib
+from copy import deepcopy
 
-__all__ = ['RoomMemory']
+__all__ = ['AsyncTTLCache', 'PersistentDict', 'PersistentSet', 'RoomMemory', 'aiterate',
+           'run_in_pool']
+
+_LOGGER = logging.getLogger(__name__)
 
 
 class RoomMemory:
     """
     A way of accessing opsdroid memory based on rooms.
+
+    The matrix database reads and writes the room set on it, so each access
+    sets the room and puts it back while holding a lock. That way concurrent
+    handlers never read or write each other's rooms.
+
+    The values of the keys in ``cached_keys`` are kept in a write-through
+    cache, so reading them again does not touch the database.
     """
+    cached_keys = ("picard.options", "is_archived")
+
     def __init__(self, opsdroid):
         self.opsdroid = opsdroid
+        self._lock = asyncio.Lock()
+        self._cache = {}
+
+    async def _in_room(self, room, func, *args):
+        async with self._lock:
+            if room is None:
+                return await func(*args)
+
+            database = self.opsdroid.memory.databases[0]
+            ori_room = database.room
+            database.room = room
+            try:
+                return await func(*args)
+            finally:
+                database.room = ori_room
+
+    async def get(self, key, room=None):
+        """
+        Get a value from the memory of ``room``, or the default room.
+        """
+        if (room, key) in self._cache:
+            return deepcopy(self._cache[(room, key)])
+
+        value = await self._in_room(room, self.opsdroid.memory.get, key)
+        if key in self.cached_keys:
+            self._cache[(room, key)] = deepcopy(value)
+
+        return value
+
+    async def put(self, key, value, room=None):
+        """
+        Store a value in the memory of ``room``, or the default room.
+        """
+        await self._in_room(room, self.opsdroid.memory.put, key, value)
+        if key in self.cached_keys:
+            self._cache[(room, key)] = deepcopy(value)
+
+
+class AsyncTTLCache:
+    """
+    A cache of the results of an async lookup, which expire after ``ttl`` seconds.
+
+    Falsy results are negative results, they are kept for ``negative_ttl``
+    seconds instead, so a missing thing is not looked up again every time
+    but is noticed soon after it appears. Concurrent lookups of the same key
+    share one call to the loader. If the loader raises, nothing is cached.
+    """
+    def __init__(self, ttl, negative_ttl=None):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self._values = {}
+        self._pending = {}
+
+    def _expiry(self, value):
+        return time.monotonic() + (self.ttl if value else self.negative_ttl)
+
+    def is_fresh(self, key):
+        return key in self._values and self._values[key][1] > time.monotonic()
+
+    def peek(self, key, default=None):
+        """
+        The cached value for ``key`` if it has not expired, without looking it up.
+        """
+        if self.is_fresh(key):
+            return self._values[key][0]
+        return default
+
+    def set(self, key, value):
+        self._values[key] = (value, self._expiry(value))
+
+    def invalidate(self, key=None):
+        """
+        Forget the value for ``key``, or for all keys.
+        """
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+    async def get(self, key, load):
+        """
+        Get the value for ``key``, awaiting ``load(key)`` if it is not cached.
+        """
+        if self.is_fresh(key):
+            return self._values[key][0]
+
+        if key not in self._pending:
+            task = asyncio.ensure_future(load(key))
+            self._pending[key] = task
+
+            def store(task):
+                if self._pending.get(key) is task:
+                    del self._pending[key]
+                if not task.cancelled() and task.exception() is None:
+                    self.set(key, task.result())
+
+            task.add_done_callback(store)
+
+        return await asyncio.shield(self._pending[key])
+
+
+async def aiterate(items):
+    """
+    Iterate asynchronously over an iterable or an async iterable.
+    """
+    if hasattr(items, '__aiter__'):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+
+async def run_in_pool(func, items, concurrency, on_complete=None):
+    """
+    Await ``func(item)`` for every item, with at most ``concurrency`` calls in flight.
+
+    ``items`` can be an iterable or an async iterable. Items are taken from it
+    only as the workers need them, so work starts on the first items while
+    a slow listing is still being downloaded, and it is never all held in memory.
+
+    Exceptions raised by ``func`` are logged and collected instead of being
+    raised, so one failing item does not stop the rest. If given,
+    ``on_complete(item, exception)`` is awaited after every item, with
+    ``exception`` being `None` on success.
+
+    If iterating ``items`` raises, the items already taken are finished and
+    then the exception is raised. The workers never outlive the call, even
+    if it is cancelled.
+
+    Returns a list of ``(item, exception)`` pairs for the items which failed.
+    """
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    failures = []
+
+    async def produce():
+        async for item in aiterate(items):
+            await queue.put(item)
+
+    async def process(item):
+        error = None
+        try:
+            await func(item)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _LOGGER.exception(f"Failed to process {item}.")
+            failures.append((item, e))
+            error = e
+
+        if on_complete:
+            try:
+                await on_complete(item, error)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _LOGGER.exception(f"Failed to report the completion of {item}.")
+
+    async def worker():
+        while True:
+            item = await queue.get()
+            try:
+                await process(item)
+            finally:
+                queue.task_done()
+
+    producer = asyncio.ensure_future(produce())
+    workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+    try:
+        try:
+            await producer
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await queue.join()
+            raise
+        await queue.join()
+    finally:
+        # The workers are stopped here rather than told to stop through the
+        # queue, which could block if it is full.
+        producer.cancel()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(producer, *workers, return_exceptions=True)
+
+    return failures
+
+
+class _ShardedCollection:
+    """
+    The storage shared by PersistentSet and PersistentDict.
+
+    The collection is split over a fixed number of shards, each stored under
+    its own key, so changing an item only rewrites the shard it is in. The
+    whole collection is loaded into memory once, after which lookups do not
+    touch the database.
+
+    If ``legacy_key`` is given and none of the shards exist yet, the
+    collection is loaded from the single value stored under that key and
+    written back as shards.
+    """
+    def __init__(self, memory, key, shards=16, legacy_key=None):
+        self.memory = memory
+        self.key = key
+        self.legacy_key = legacy_key
+        self._shards = [self._new_shard() for _ in range(shards)]
+        self._shard_locks = [asyncio.Lock() for _ in range(shards)]
+        self._loaded = False
+        self._load_lock = asyncio.Lock()
+
+    def _new_shard(self):
+        raise NotImplementedError
+
+    def _shard(self, item):
+        return zlib.crc32(item.encode()) % len(self._shards)
+
+    def _shard_key(self, shard):
+        return f"{self.key}.{shard}"
+
+    async def load(self):
+        """
+        Load the collection from memory, if it has not been loaded already.
+        """
+        if self._loaded:
+            return
+        async with self._load_lock:
+            if self._loaded:
+                return
+
+            found_shard = False
+            for shard in range(len(self._shards)):
+                items = await self.memory.get(self._shard_key(shard))
+                if items is not None:
+                    found_shard = True
+                    self._shards[shard].update(items)
+
+            self._loaded = True
+
+            if not found_shard and self.legacy_key:
+                legacy_items = await self.memory.get(self.legacy_key)
+                if legacy_items:
+                    await self.update(legacy_items)
+
+    async def _write_shards(self, shards):
+        for shard in shards:
+            async with self._shard_locks[shard]:
+                await self.memory.put(self._shard_key(shard), self._dump_shard(shard))
+
+    def _dump_shard(self, shard):
+        raise NotImplementedError
+
+    async def update(self, items):
+        raise NotImplementedError
+
+    def __contains__(self, item):
+        return item in self._shards[self._shard(item)]
+
+    def __iter__(self):
+        return iter([item for shard in self._shards for item in shard])
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+
+
+class PersistentSet(_ShardedCollection):
+    """
+    A set of strings stored in opsdroid memory.
+
+    Adding or removing an item only rewrites the shard it is in.
+    """
+    def _new_shard(self):
+        return set()
+
+    def _dump_shard(self, shard):
+        return list(self._shards[shard])
+
+    async def update(self, items):
+        """
+        Add all the items to the set.
+        """
+        await self.load()
+        changed = set()
+        for item in items:
+            shard = self._shard(item)
+            if item not in self._shards[shard]:
+                self._shards[shard].add(item)
+                changed.add(shard)
+
+        await self._write_shards(changed)
+
+    async def difference_update(self, items):
+        """
+        Remove all the items from the set.
+        """
+        await self.load()
+        changed = set()
+        for item in items:
+            shard = self._shard(item)
+            if item in self._shards[shard]:
+                self._shards[shard].remove(item)
+                changed.add(shard)
+
+        await self._write_shards(changed)
+
+    async def add(self, item):
+        await self.update([item])
+
+    async def discard(self, item):
+        await self.difference_update([item])
+
+
+class PersistentDict(_ShardedCollection):
+    """
+    A dict with string keys stored in opsdroid memory.
+
+    Setting or removing a key only rewrites the shard it is in.
+    """
+    def _new_shard(self):
+        return {}
+
+    def _dump_shard(self, shard):
+        return dict(self._shards[shard])
+
+    async def update(self, items):
+        """
+        Set all the keys in the given dict.
+        """
+        await self.load()
+        changed = set()
+        for key, value in dict(items).items():
+            shard = self._shard(key)
+            if self._shards[shard].get(key, object()) != value:
+                self._shards[shard][key] = value
+                changed.add(shard)
+
+        await self._write_shards(changed)
+
+    async def set(self, key, value):
+        await self.update({key: value})
+
+    async def pop(self, key, default=None):
+        await self.load()
+        shard = self._shard(key)
+        if key not in self._shards[shard]:
+            return default
+
+        value = self._shards[shard].pop(key)
+        await self._write_shards([shard])
+        return value
+
+    def get(self, key, default=None):
+        return self._shards[self._shard(key)].get(key, default)
 
-    @contextmanager
-    def memory_in_room(self, room):
-        ori_room = self.opsdroid.memory.databases[0].room
-        self.opsdroid.memory.databases[0].room = room
-        yield
-        self.opsdroid.memory.databases[0].room = ori_room
+    def __getitem__(self, key):
+        return self._shards[self._shard(key)][key]
 
-    def __getitem__(self, item):
-        return self.memory_in_room(item)
+    def items(self):
+        return [item for shard in self._shards for item in shard.items()]